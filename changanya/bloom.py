@@ -7,45 +7,367 @@ Implementation of a Bloom filter in Python.
 The Bloom filter is a space-efficient probabilistic data structure that is
 used to test whether an element is a member of a set. False positives are
 possible, but false negatives are not. Elements can be added to the set, but
-not removed. The more elements that are added to the set, the larger the
-probability of false positives.
+not removed (use a `CountingBloomfilter` if you need to remove them). The more
+elements that are added to the set, the larger the probability of false
+positives.
 
-Uses SHA-1 from Python's hashlib, but you can swap that out with any other
-160-bit hash function. Also keep in mind that it starts off very sparse and
-become more dense (and false-positive-prone) as you add more elements.
+All of the filter's bit positions are derived from a single 128-bit digest
+(split into two 64-bit halves) via (enhanced) double hashing. The digest
+comes from BLAKE2b in Python's hashlib by default (SHA-1 before Python 3.6),
+but you can select any function in `HASH_FUNCS` (or register your own there).
+Also keep in mind that it starts off very sparse and become more dense (and
+false-positive-prone) as you add more elements.
 
 Part of changanya by reubano. See README and LICENSE.
 """
 
+import os
 import math
+import mmap
 import hashlib
+import pickle
+import traceback
 
+from contextlib import ExitStack
 from functools import reduce
+from multiprocessing import Process, Queue
+from queue import Empty, Full
+from threading import Lock
+from struct import Struct
 
-from changanya.hashtype import Hashtype
+from changanya.hashtype import (
+    BATCH_SIZE, Hashtype, chunked, pairwise, popcount)
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+MASK64 = (1 << 64) - 1
+MAX_COUNT = 15
+BLOCK_BITS = 512
+DEF_STRIPES = 64
+POLL_INTERVAL = 1
+_HALVES = Struct('<QQ')
+
+# File/bytes header: magic, version, flags, hash function name, hashbits,
+# num_hashes, count, capacity, and false positive rate (64 bytes total)
+_HEADER = Struct('<4sHH16sQQQQd')
+MAGIC = b'CBLM'
+VERSION = 1
+FLAG_COUNTING = 1
+FLAG_BLOCKED = 2
+
+# Lookup tables for counters packed two per byte (low nibble first)
+_NONZERO = bytes(
+    bool(b & 15) | (bool(b >> 4) << 1) for b in range(256))
+_SATURATED = bytes(
+    ((b & 15) == MAX_COUNT) + ((b >> 4) == MAX_COUNT) for b in range(256))
+_SHIFTS = [bytes((b << 2 * i) & 255 for b in range(256)) for i in range(4)]
+
+# And the reverse: counters of 1 for the ith pair of bits in a byte
+_SPREAD = [
+    bytes((b >> 2 * i & 1) | (b >> 2 * i + 1 & 1) << 4 for b in range(256))
+    for i in range(4)]
+
+
+def _rotl64(x, r):
+    return ((x << r) | (x >> (64 - r))) & MASK64
+
+
+def _fmix64(k):
+    k ^= k >> 33
+    k = (k * 0xff51afd7ed558ccd) & MASK64
+    k ^= k >> 33
+    k = (k * 0xc4ceb9fe1a85ec53) & MASK64
+    return k ^ (k >> 33)
+
+
+def murmur3(data, seed=0):
+    """Pure Python MurmurHash3 (x64, 128-bit variant).
+
+    Returns the digest as a pair of 64-bit integers.
+    """
+    c1, c2 = 0x87c37b91114253d5, 0x4cf5ad432745937f
+    length = len(data)
+    h1 = h2 = seed
+    tail_start = length - (length & 15)
+
+    for start in range(0, tail_start, 16):
+        k1, k2 = _HALVES.unpack_from(data, start)
+
+        k1 = (_rotl64((k1 * c1) & MASK64, 31) * c2) & MASK64
+        h1 = _rotl64(h1 ^ k1, 27)
+        h1 = ((((h1 + h2) & MASK64) * 5) + 0x52dce729) & MASK64
+
+        k2 = (_rotl64((k2 * c2) & MASK64, 33) * c1) & MASK64
+        h2 = _rotl64(h2 ^ k2, 31)
+        h2 = ((((h2 + h1) & MASK64) * 5) + 0x38495ab5) & MASK64
+
+    tail = data[tail_start:]
+
+    if len(tail) > 8:
+        k2 = int.from_bytes(tail[8:], 'little')
+        h2 ^= (_rotl64((k2 * c2) & MASK64, 33) * c1) & MASK64
+
+    if tail:
+        k1 = int.from_bytes(tail[:8], 'little')
+        h1 ^= (_rotl64((k1 * c1) & MASK64, 31) * c2) & MASK64
+
+    h1 ^= length
+    h2 ^= length
+    h1 = (h1 + h2) & MASK64
+    h2 = (h2 + h1) & MASK64
+    h1 = _fmix64(h1)
+    h2 = _fmix64(h2)
+    h1 = (h1 + h2) & MASK64
+    h2 = (h2 + h1) & MASK64
+    return (h1, h2)
+
+
+def _is_prime(n):
+    if n < 4:
+        return n > 1
+    elif not n % 2:
+        return False
+
+    return all(n % d for d in range(3, int(math.sqrt(n)) + 1, 2))
+
+
+def _next_prime(n):
+    "The smallest prime that is at least 'n'"
+    while not _is_prime(n):
+        n += 1
+
+    return n
+
+
+def blake2b(data):
+    "BLAKE2b (from hashlib) truncated to a pair of 64-bit integers."
+    return _HALVES.unpack(hashlib.blake2b(data, digest_size=16).digest())
+
+
+def sha1(data):
+    "SHA-1 (from hashlib) truncated to a pair of 64-bit integers."
+    return _HALVES.unpack_from(hashlib.sha1(data).digest())
+
+
+def _build_shard(cls, kwargs, batches, results):
+    """Build one part of `Bloomfilter.build_parallel` (in a worker process)
+    from batches of items until it gets None. Puts the filter (or the
+    error) in 'results' once.
+    """
+    try:
+        bloomfilter = cls(**kwargs)
+
+        for chunk in iter(batches.get, None):
+            bloomfilter.add_many(chunk)
+
+        results.put(bloomfilter.to_bytes())
+    except Exception as e:
+        # The queue pickles in a background thread and drops what it can't
+        # pickle, so make sure the parent hears about the error
+        try:
+            pickle.dumps(e)
+        except Exception:
+            lines = traceback.format_exception(type(e), e, e.__traceback__)
+            e = RuntimeError(''.join(lines))
+
+        results.put(e)
+
+
+def _worker_error(results):
+    "The error sent by a failed worker (or a generic one if it died)"
+    try:
+        error = results.get(timeout=POLL_INTERVAL)
+    except Empty:
+        error = None
+
+    if isinstance(error, Exception):
+        return error
+
+    return RuntimeError('A worker process exited unexpectedly')
+
+
+def _send(batches, chunk, results, processes):
+    "Put a batch of items in the workers' queue unless one of them failed"
+    while True:
+        # Until they get None, the workers only send (or exit) on failure
+        if not results.empty() or any(
+                process.exitcode is not None for process in processes):
+            raise _worker_error(results)
+
+        try:
+            return batches.put(chunk, timeout=POLL_INTERVAL)
+        except Full:
+            pass
+
+
+def _wait_for(method, processes, results, *args):
+    """Call a blocking queue method, but raise (the error of a worker, if
+    any) once all of the 'processes' (that feed or drain the queue) exited
+    """
+    while True:
+        try:
+            return method(*args, timeout=POLL_INTERVAL)
+        except (Empty, Full):
+            if all(process.exitcode is not None for process in processes):
+                break
+
+    # Anything the workers sent before exiting has arrived by now
+    try:
+        return method(*args, timeout=POLL_INTERVAL)
+    except (Empty, Full):
+        raise _worker_error(results)
+
+
+# Each function takes bytes and returns two (independent) 64-bit integers
+HASH_FUNCS = {'murmur3': murmur3, 'sha1': sha1}
+
+# hashlib only has BLAKE2b on Python 3.6+
+if hasattr(hashlib, 'blake2b'):
+    HASH_FUNCS['blake2b'] = blake2b
+    DEF_HASH_FUNC = 'blake2b'
+else:
+    DEF_HASH_FUNC = 'sha1'
 
 
 class Bloomfilter(Hashtype):
-    def __init__(self, data='', capacity=3000, false_positive_rate=0.01):
+    def __init__(
+            self, data='', capacity=3000, false_positive_rate=0.01,
+            hash_func=DEF_HASH_FUNC):
         """
         'data' is the initial string or list of strings to hash,
-        'capacity' is the expected upper limit on items inserted, and
+        'capacity' is the expected upper limit on items inserted,
         'false_positive_rate' is self-explanatory but the smaller it is,
-        the larger your hashes!
+        the larger your hashes!, and 'hash_func' is the name of the
+        `HASH_FUNCS` entry used to digest items.
         """
+        self._configure(capacity, false_positive_rate, hash_func)
+        super(Bloomfilter, self).__init__(self.hashbits)
+        self.create_hash(data)
+
+    _storage = 'bits'
+    _flags = 0
+
+    def _configure(
+            self, capacity, false_positive_rate, hash_func, sizes=None):
+        """'sizes' is a (hashbits, num_hashes) pair and defaults to the
+        optimal size for the (integer) capacity and error rate
+        """
+        if hash_func not in HASH_FUNCS:
+            raise ValueError('Unknown hash function %s' % hash_func)
+
         self.encoding = 'utf-8'
-        hashbits, self.num_hashes = self._optimal_size(
-            capacity, false_positive_rate)
+        self.hash_func = hash_func
+        self._digest = HASH_FUNCS[hash_func]
+        self.capacity = int(capacity)  # it's saved as an unsigned integer
+        self.false_positive_rate = false_positive_rate
+        self.count = 0
+        self.hashbits, self.num_hashes = sizes or self._optimal_size(
+            self.capacity, false_positive_rate)
+
+    @property
+    def hash(self):
+        """The filter bits as a (little endian) integer.
+
+        Only built on demand since it copies the whole bit array.
+        """
+        return int.from_bytes(self.bits, 'little')
+
+    @hash.setter
+    def hash(self, value):
+        num_bytes = self._num_bytes()
+
+        if value:
+            self.bits = bytearray(value.to_bytes(num_bytes, 'little'))
+        else:
+            self.bits = bytearray(num_bytes)
+
+    def _num_bytes(self):
+        return (self.hashbits + 7) // 8
+
+    @property
+    def fill_ratio(self):
+        "The fraction of bits that are set"
+        return popcount(self.hash) / self.hashbits
+
+    @property
+    def estimated_false_positive_rate(self):
+        "The false positive rate implied by the current fill ratio"
+        return self.fill_ratio ** self.num_hashes
+
+    def _set_bits(self, positions):
+        bits = self.bits
+
+        for pos in positions:
+            bits[pos >> 3] |= 1 << (pos & 7)
 
-        super(Bloomfilter, self).__init__(hashbits)
-        self.hash = self.create_hash(data)
+    def _test_bits(self, positions):
+        bits = self.bits
+        return all(bits[pos >> 3] & (1 << (pos & 7)) for pos in positions)
 
-    def _add(self, _hash, item):
-        return reduce(lambda x, y: x | (2 ** y), self._hashes(item), _hash)
+    def _set_array(self, indices):
+        "Vectorized `_set_bits` for a 2-D array of positions (one row/item)"
+        view = np.frombuffer(self.bits, dtype=np.uint8)
+        indices = indices.ravel()
+        values = np.left_shift(np.uint64(1), indices & np.uint64(7))
+        values = values.astype(np.uint8)
+        np.bitwise_or.at(view, indices >> np.uint64(3), values)
+
+    def _test_array(self, indices):
+        "Vectorized `_test_bits` for a 2-D array of positions (one row/item)"
+        view = np.frombuffer(self.bits, dtype=np.uint8)
+        found = view[indices >> np.uint64(3)] >> (indices & np.uint64(7))
+        return (found & np.uint64(1)).all(axis=1)
+
+    def _use_numpy(self, vectorize):
+        if vectorize and np is None:
+            raise ImportError('numpy is required to vectorize')
+
+        return np is not None if vectorize is None else vectorize
+
+    def _incr_count(self, num):
+        self.count += num
 
     def add(self, item):
         "Add an item (string) to the filter. Cannot be removed later!"
-        self.hash = self._add(self.hash, item)
+        self._set_bits(self._hashes(item))
+        self._incr_count(1)
+
+    def add_many(self, items, vectorize=None):
+        """Add an iterable of items (strings) to the filter.
+
+        If 'vectorize' is True (the default when numpy is installed), the
+        positions of each batch of items are computed and set with numpy.
+        """
+        use_numpy = self._use_numpy(vectorize)
+
+        for chunk in chunked(items):
+            if use_numpy:
+                self._set_array(self._probe_array(chunk))
+            else:
+                for item in chunk:
+                    self._set_bits(self._hashes(item))
+
+            self._incr_count(len(chunk))
+
+    def contains_many(self, items, vectorize=None):
+        """Check an iterable of items (strings) for membership.
+
+        Returns a list of booleans in the same order as 'items'. See
+        `add_many` for the meaning of 'vectorize'.
+        """
+        if not self._use_numpy(vectorize):
+            return [self._test_bits(self._hashes(item)) for item in items]
+
+        results = []
+
+        for chunk in chunked(items):
+            found = self._test_array(self._probe_array(chunk))
+            results.extend(found.tolist())
+
+        return results
 
     def create_hash(self, data):
         """
@@ -56,44 +378,67 @@ class Bloomfilter(Hashtype):
         http://bitworking.org/news/380/bloom-filter-resources
         """
         if data and type(data) == str:
-            _hash = self._add(0, data)
+            self.add(data)
         elif data:
-            _hash = reduce(self._add, data, 0)
-        else:
-            _hash = 0
+            self.add_many(data)
 
-        return _hash
+    def _encode(self, item):
+        return item.encode(self.encoding) if hasattr(item, 'encode') else item
+
+    def _digest_array(self, items):
+        "Vectorized `_digest` returning a (len(items), 2) array"
+        digests = [self._digest(self._encode(item)) for item in items]
+        return np.array(digests, dtype=np.uint64).reshape(-1, 2)
+
+    def _probe_array(self, items):
+        "Vectorized `_hashes` returning a (len(items), num_hashes) array"
+        return self._position_array(self._digest_array(items))
+
+    def _position_array(self, digests):
+        "Vectorized `_positions`"
+        hashbits = np.uint64(self.hashbits)
+        pos = digests[:, 0] % hashbits
+        steps = np.uint64(max(self.hashbits - 1, 1))
+        step = digests[:, 1] % steps + np.uint64(1)
+        offsets = np.arange(self.num_hashes, dtype=np.uint64)
+        cubes = (offsets ** np.uint64(3) - offsets) // np.uint64(6)
+        probes = pos[:, None] + offsets[None, :] * step[:, None]
+        return (probes + cubes[None, :]) % hashbits
 
     def _hashes(self, item):
         """
-        To create the hash functions we use the SHA-1 hash of the
-        string and chop that up into 20 bit values and then
-        mod down to the length of the Bloom filter.
+        To create the hash functions we split a 128-bit digest of the
+        string into two 64-bit values (h1, h2) and use the ith position
+        (h1 + i * h2 + (i^3 - i) / 6) mod the length of the Bloom filter.
+        The cubic term (enhanced double hashing) keeps the probes from
+        repeating when h2 shares a large factor with the length.
+
+        Reference material:
+        https://www.eecs.harvard.edu/~michaelm/postscripts/rsa2008.pdf
+        https://www.ccs.neu.edu/home/pete/pub/bloom-filters-verification.pdf
         """
-        if hasattr(item, 'encode'):
-            item = item.encode(self.encoding)
+        return self._positions(*self._digest(self._encode(item)))
 
-        m = hashlib.sha1()
-        m.update(item)
-        digits = m.hexdigest()
+    def _positions(self, h1, h2):
+        hashbits = self.hashbits
 
-        # Add another 160 bits for every 8 (20-bit long) hashes we need
-        for i in range(self.num_hashes // 8):
-            m.update(str(i))
-            digits += m.hexdigest()
+        # Never let the step be 0 (mod hashbits), otherwise every probe
+        # would land on the same bit (unless there is only one)
+        pos, step = h1 % hashbits, h2 % max(hashbits - 1, 1) + 1
 
-        hashes = [
-            int(digits[i * 5:i * 5 + 5], 16) % self.hashbits
+        return [
+            (pos + i * step + (i ** 3 - i) // 6) % hashbits
             for i in range(self.num_hashes)]
 
-        return hashes
-
     def _optimal_size(self, capacity, error):
         """Calculates minimum number of bits in filter array and
         number of hash functions given a number of enteries (maximum)
         and the desired error rate (false positives).
 
-        Example: m, k = self._optimal_size(3000, 0.01)   # m=28756, k=7
+        The number of bits is rounded up to a prime, so that no step of
+        the double hashing in `_positions` shares a factor with it.
+
+        Example: m, k = self._optimal_size(3000, 0.01)   # m=28759, k=7
 
         Source:
         http://en.wikipedia.org/wiki/Bloom_filter#Optimal_number_of_hash_functions
@@ -101,13 +446,643 @@ class Bloomfilter(Hashtype):
         numerator = capacity * math.log(error)
         m = math.ceil(numerator / math.log(1 / (math.pow(2, math.log(2)))))
         k = math.ceil(math.log(2) * m / capacity)
-        return (int(m), int(k))
+        return (_next_prime(int(m)), int(k))
 
     def __contains__(self, name):
         "This function is used by the 'in' keyword"
-        retval = True
+        return self._test_bits(self._hashes(name))
+
+    def _header(self):
+        hash_func = self.hash_func.encode('ascii')
+
+        if len(hash_func) > 16:
+            raise ValueError('Hash function names are limited to 16 chars')
+
+        return _HEADER.pack(
+            MAGIC, VERSION, self._flags, hash_func,
+            self.hashbits, self.num_hashes, self.count, self.capacity,
+            self.false_positive_rate)
+
+    @classmethod
+    def _from_buffer(cls, buf):
+        """Create a filter from a header and its storage without copying it.
+        Returns the filter and the (sliced) storage memoryview.
+        """
+        bloomfilter = cls.__new__(cls)
+        return bloomfilter, bloomfilter._read_header(buf)
+
+    def _read_header(self, buf):
+        "Configure the filter from a header. Returns the storage memoryview."
+        if len(buf) < _HEADER.size:
+            raise ValueError('Not enough data for a Bloom filter header')
+
+        header = _HEADER.unpack_from(buf)
+        magic, version, flags, hash_func, hashbits, num_hashes = header[:6]
+        count, capacity, false_positive_rate = header[6:]
+
+        if magic != MAGIC or version != VERSION:
+            raise ValueError('Not a (supported) Bloom filter file')
+        elif flags != self._flags:
+            raise ValueError('Data is not for a %s' % type(self).__name__)
+
+        hash_func = hash_func.rstrip(b'\0').decode('ascii')
+        sizes = (hashbits, num_hashes)
+        self._configure(capacity, false_positive_rate, hash_func, sizes)
+        self.count = count
+
+        # The stored sizes are used as is (unless a layout can't have them)
+        if not (hashbits and num_hashes) or (
+                self.hashbits, self.num_hashes) != sizes:
+            raise ValueError('Header sizes are inconsistent')
+
+        end = _HEADER.size + self._num_bytes()
+        storage = memoryview(buf)[_HEADER.size:end]
+
+        if len(storage) < end - _HEADER.size:
+            storage.release()
+            raise ValueError('Bloom filter data is truncated')
+
+        return storage
+
+    def copy(self):
+        "A (writable, in memory) copy of the filter"
+        bloomfilter = type(self).__new__(type(self))
+        sizes = (self.hashbits, self.num_hashes)
+        bloomfilter._configure(
+            self.capacity, self.false_positive_rate, self.hash_func, sizes)
+
+        bloomfilter.count = self.count
+        storage = bytearray(getattr(self, self._storage))
+        setattr(bloomfilter, self._storage, storage)
+        return bloomfilter
+
+    def _merge(self, other, op, np_op):
+        "Combine another filter's bits into this one (in place)"
+        if not isinstance(other, Bloomfilter):
+            return False
+        elif (self._flags | other._flags) & FLAG_COUNTING:
+            raise TypeError(
+                'Only plain Bloom filters can be combined (see '
+                '`CountingBloomfilter.to_bloomfilter`)')
+
+        ours = (self._flags, self.hashbits, self.num_hashes, self.hash_func)
+        theirs = (
+            other._flags, other.hashbits, other.num_hashes, other.hash_func)
+
+        if ours != theirs:
+            raise ValueError(
+                'Filters must have the same layout, size, number of hashes, '
+                'and hash function to be combined')
+
+        if np is None:
+            merged = op(self.hash, other.hash)
+            self.bits[:] = merged.to_bytes(self._num_bytes(), 'little')
+        else:
+            view = np.frombuffer(self.bits, dtype=np.uint8)
+            np_op(view, np.frombuffer(other.bits, dtype=np.uint8), out=view)
+
+        return True
+
+    def __ior__(self, other):
+        "Union: an item in either filter is in the result"
+        if not self._merge(other, int.__or__, getattr(np, 'bitwise_or', None)):
+            return NotImplemented
+
+        self._incr_count(other.count)
+        return self
+
+    def __iand__(self, other):
+        """Intersection: an item in both filters is in the result. This is
+        equivalent to (but may have a higher false positive rate than) a
+        filter built from the intersection of the items. The resulting count
+        is only an upper bound.
+        """
+        and_op = getattr(np, 'bitwise_and', None)
+
+        if not self._merge(other, int.__and__, and_op):
+            return NotImplemented
+
+        self.count = min(self.count, other.count)
+        return self
+
+    def __or__(self, other):
+        if not isinstance(other, Bloomfilter):
+            return NotImplemented
+
+        bloomfilter = self.copy()
+        bloomfilter |= other
+        return bloomfilter
+
+    def __and__(self, other):
+        if not isinstance(other, Bloomfilter):
+            return NotImplemented
+
+        bloomfilter = self.copy()
+        bloomfilter &= other
+        return bloomfilter
+
+    @classmethod
+    def build_parallel(
+            cls, items, workers=None, batch_size=4 * BATCH_SIZE, **kwargs):
+        """Build a filter from an iterable of items using worker processes.
+
+        The items are sent to the workers in batches of 'batch_size'. Each
+        worker adds its batches to one filter of its own, and the workers'
+        filters are OR-ed together once all of the items are added.
+        'kwargs' are passed to the constructor (e.g., `capacity`,
+        `false_positive_rate`, and `hash_func`).
+        """
+        if cls._flags & FLAG_COUNTING:
+            raise TypeError('%s filters can not be merged' % cls.__name__)
+
+        bloomfilter = cls(**kwargs)
+        workers = workers or os.cpu_count() or 1
+
+        # Limit the number of batches held in memory at once
+        batches, results = Queue(2 * workers), Queue()
+        args = (cls, kwargs, batches, results)
+        processes = [
+            Process(target=_build_shard, args=args, daemon=True)
+            for _ in range(workers)]
+
+        [process.start() for process in processes]
+
+        try:
+            for chunk in chunked(items, batch_size):
+                _send(batches, chunk, results, processes)
+
+            for _ in processes:
+                _wait_for(batches.put, processes, results, None)
+
+            for _ in processes:
+                result = _wait_for(results.get, processes, results)
+
+                if isinstance(result, Exception):
+                    raise result
+
+                bloomfilter |= cls.from_bytes(result)
+        except BaseException:
+            [process.terminate() for process in processes]
+            raise
+        finally:
+            [process.join() for process in processes]
+
+        return bloomfilter
+
+    def to_bytes(self):
+        "Serialize the filter to a header followed by its raw storage"
+        return self._header() + bytes(getattr(self, self._storage))
+
+    @classmethod
+    def from_bytes(cls, data):
+        "Create a filter from the output of `to_bytes`"
+        bloomfilter, storage = cls._from_buffer(data)
+        setattr(bloomfilter, cls._storage, bytearray(storage))
+        return bloomfilter
+
+    def __getstate__(self):
+        """Pickle (and copy) the header and storage (see `to_bytes`) instead
+        of the attributes. Otherwise the `hash` slot would be saved and
+        restored through its property.
+        """
+        return self.to_bytes()
+
+    def __setstate__(self, state):
+        storage = self._read_header(state)
+        setattr(self, self._storage, bytearray(storage))
+
+    def save(self, path):
+        "Write the filter to a file (see `to_bytes` for the format)"
+        with open(path, 'wb') as f:
+            f.write(self._header())
+            f.write(getattr(self, self._storage))
+
+    @classmethod
+    def open(cls, path, mode='r'):
+        """Memory map a filter saved with `save`. The filter's storage is
+        shared with the OS page cache (and therefore any other process that
+        opens the same file) instead of being read into memory.
+
+        'mode' is either 'r' (read-only) or 'r+' (changes are written back
+        to the file). Call `close` (or use a `with` block) when done.
+        """
+        modes = {
+            'r': ('rb', mmap.ACCESS_READ), 'r+': ('r+b', mmap.ACCESS_WRITE)}
+
+        if mode not in modes:
+            raise ValueError('Mode must be one of %s' % ', '.join(modes))
+
+        file_mode, access = modes[mode]
+
+        with open(path, file_mode) as f:
+            mapped = mmap.mmap(f.fileno(), 0, access=access)
+
+        view = memoryview(mapped)
+
+        try:
+            bloomfilter, storage = cls._from_buffer(view)
+        except ValueError:
+            view.release()
+            mapped.close()
+            raise
+
+        setattr(bloomfilter, cls._storage, storage)
+        bloomfilter._mapped = (mapped, view)
+        return bloomfilter
+
+    def flush(self):
+        "Write the current count of a filter opened in 'r+' mode to disk"
+        mapped, view = self._mapped
+        view[:_HEADER.size] = self._header()
+        mapped.flush()
+
+    def close(self):
+        "Unmap a filter created by `open`"
+        mapped, view = getattr(self, '_mapped', (None, None))
+
+        if mapped is not None:
+            getattr(self, self._storage).release()
+            view.release()
+            mapped.close()
+            setattr(self, self._storage, None)
+            self._mapped = (None, None)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class ScalableBloomfilter(object):
+    def __init__(
+            self, data='', capacity=3000, false_positive_rate=0.01,
+            hash_func=DEF_HASH_FUNC, growth=2, tightening=0.9):
+        """A Bloom filter that keeps its false positive rate no matter how
+        many items are added to it. Once the current filter reaches its
+        capacity, a new filter is appended that is 'growth' times larger and
+        has an error rate 'tightening' times smaller.
+
+        'capacity' is the size of the first filter and 'false_positive_rate'
+        is the upper bound on the error rate of the whole chain. The
+        remaining arguments are the same as for `Bloomfilter`.
+
+        Reference material:
+        http://gsd.di.uminho.pt/members/cbm/ps/dbloom.pdf
+        """
+        if not 0 < tightening < 1:
+            raise ValueError('tightening must be between 0 and 1')
+
+        self.initial_capacity = capacity
+        self.false_positive_rate = false_positive_rate
+        self.hash_func = hash_func
+        self.growth = growth
+        self.tightening = tightening
+        self.filters = []
+        self._grow()
+
+        if data and type(data) == str:
+            self.add(data)
+        elif data:
+            self.add_many(data)
+
+    def _grow(self):
+        num_filters = len(self.filters)
+        capacity = self.initial_capacity * self.growth ** num_filters
+
+        # The error rates form a geometric series that sums to (at most)
+        # `false_positive_rate`
+        first_error = self.false_positive_rate * (1 - self.tightening)
+        error = first_error * self.tightening ** num_filters
+        bloomfilter = Bloomfilter(
+            capacity=capacity, false_positive_rate=error,
+            hash_func=self.hash_func)
+
+        self.filters.append(bloomfilter)
+        return bloomfilter
+
+    @property
+    def _current(self):
+        bloomfilter = self.filters[-1]
+
+        if bloomfilter.count >= bloomfilter.capacity:
+            bloomfilter = self._grow()
+
+        return bloomfilter
+
+    @property
+    def count(self):
+        return sum(bloomfilter.count for bloomfilter in self.filters)
+
+    @property
+    def capacity(self):
+        return sum(bloomfilter.capacity for bloomfilter in self.filters)
+
+    @property
+    def hashbits(self):
+        return sum(bloomfilter.hashbits for bloomfilter in self.filters)
+
+    @property
+    def fill_ratio(self):
+        "The fraction of bits that are set (across all filters)"
+        ones = sum(popcount(bloomfilter.hash) for bloomfilter in self.filters)
+        return ones / self.hashbits
+
+    @property
+    def estimated_false_positive_rate(self):
+        "The false positive rate implied by the filters' fill ratios"
+        rates = (b.estimated_false_positive_rate for b in self.filters)
+        return 1 - reduce(lambda x, y: x * (1 - y), rates, 1)
+
+    def add(self, item):
+        "Add an item (string) to the filter unless it is already present"
+        if item not in self:
+            self._current.add(item)
+
+    def add_many(self, items, vectorize=None):
+        "Add an iterable of items (strings) that aren't already present"
+        for chunk in chunked(items):
+            found = self.contains_many(chunk, vectorize)
+            new, added = [], set()
+
+            # Repeats within a chunk aren't in the filters yet
+            for item, seen in zip(chunk, found):
+                if not (seen or item in added):
+                    new.append(item)
+                    added.add(item)
+
+            while new:
+                bloomfilter = self._current
+                room = bloomfilter.capacity - bloomfilter.count
+                bloomfilter.add_many(new[:room], vectorize)
+                new = new[room:]
+
+    def contains_many(self, items, vectorize=None):
+        """Check an iterable of items (strings) for membership.
+
+        Returns a list of booleans in the same order as 'items'.
+        """
+        first = self.filters[0]
+
+        if not first._use_numpy(vectorize):
+            return [item in self for item in items]
+
+        results = []
+
+        for chunk in chunked(items):
+            digests = first._digest_array(chunk)
+            found = np.zeros(len(chunk), dtype=bool)
+
+            for bloomfilter in self.filters:
+                indices = bloomfilter._position_array(digests)
+                found |= bloomfilter._test_array(indices)
+
+            results.extend(found.tolist())
+
+        return results
+
+    def __contains__(self, name):
+        "This function is used by the 'in' keyword"
+        first = self.filters[0]
+        digest = first._digest(first._encode(name))
+
+        return any(
+            bloomfilter._test_bits(bloomfilter._positions(*digest))
+            for bloomfilter in reversed(self.filters))
+
+
+class CountingBloomfilter(Bloomfilter):
+    def __init__(self, *args, **kwargs):
+        """A Bloom filter that supports removing items. Each position holds
+        a 4-bit counter (two per byte) instead of a single bit. Takes the
+        same arguments as `Bloomfilter`.
+
+        A counter that reaches `MAX_COUNT` is saturated and stays there
+        since its true value is unknown, so it may keep false positives
+        around. Only remove items that were added: removing a false
+        positive decrements other items' counters and can cause false
+        negatives.
+        """
+        super(CountingBloomfilter, self).__init__(*args, **kwargs)
+
+    @property
+    def hash(self):
+        "The bits (non-zero counters) as a (little endian) integer"
+        return int.from_bytes(self._bit_view(), 'little')
+
+    @hash.setter
+    def hash(self, value):
+        num_bytes = self._num_bytes()
+
+        if not value:
+            self.counters = bytearray(num_bytes)
+            return
+
+        bits = value.to_bytes(
+            super(CountingBloomfilter, self)._num_bytes(), 'little')
+
+        # Each byte of bits fills 4 bytes of counters
+        counters = bytearray(4 * len(bits))
+
+        for i, table in enumerate(_SPREAD):
+            counters[i::4] = bits.translate(table)
+
+        del counters[num_bytes:]
+        self.counters = counters
+
+    _storage = 'counters'
+    _flags = FLAG_COUNTING
+
+    def _num_bytes(self):
+        return (self.hashbits + 1) // 2
+
+    def _translate(self, table):
+        counters = self.counters
+
+        if not isinstance(counters, bytearray):
+            counters = bytes(counters)
+
+        return counters.translate(table)
+
+    @property
+    def saturated(self):
+        "The number of counters stuck at `MAX_COUNT`"
+        return sum(self._translate(_SATURATED))
+
+    def _bit_view(self):
+        "The non-zero counters packed into a bytearray of bits"
+        num_bytes = super(CountingBloomfilter, self)._num_bytes()
+        pairs = self._translate(_NONZERO).ljust(num_bytes * 4, b'\0')
+        view = 0
+
+        # `pairs` holds 2 bits per byte, so merge every 4 consecutive bytes
+        for i, table in enumerate(_SHIFTS):
+            view |= int.from_bytes(pairs[i::4].translate(table), 'little')
+
+        return bytearray(view.to_bytes(num_bytes, 'little'))
+
+    def _set_bits(self, positions):
+        counters = self.counters
+
+        # An item's probes may repeat, but each counter only counts it once
+        for pos in set(positions):
+            shift = (pos & 1) << 2
+
+            if (counters[pos >> 1] >> shift) & 15 < MAX_COUNT:
+                counters[pos >> 1] += 1 << shift
+
+    def _unset_bits(self, positions):
+        counters = self.counters
+
+        for pos in set(positions):
+            shift = (pos & 1) << 2
+
+            if (counters[pos >> 1] >> shift) & 15 < MAX_COUNT:
+                counters[pos >> 1] -= 1 << shift
+
+    def _test_bits(self, positions):
+        counters = self.counters
+        return all(
+            (counters[pos >> 1] >> ((pos & 1) << 2)) & 15 for pos in positions)
+
+    def _set_array(self, indices):
+        # Counters can overflow, so they can't be incremented in bulk
+        for positions in indices.tolist():
+            self._set_bits(positions)
+
+    def _test_array(self, indices):
+        view = np.frombuffer(self.counters, dtype=np.uint8)
+        shifts = (indices & np.uint64(1)) << np.uint64(2)
+        found = view[indices >> np.uint64(1)] >> shifts
+        return (found & np.uint64(15)).all(axis=1)
+
+    def remove(self, item):
+        """Remove an item (string) that was added to the filter. Raises
+        KeyError if it isn't present (but can't detect false positives).
+        """
+        positions = self._hashes(item)
+
+        if not self._test_bits(positions):
+            raise KeyError(item)
+
+        self._unset_bits(positions)
+        self._incr_count(-1)
+
+    def to_bloomfilter(self):
+        "A plain `Bloomfilter` with the same bits (non-zero counters)"
+        bloomfilter = Bloomfilter(
+            capacity=self.capacity,
+            false_positive_rate=self.false_positive_rate,
+            hash_func=self.hash_func)
+
+        bloomfilter.bits = self._bit_view()
+        bloomfilter.count = self.count
+        return bloomfilter
+
+
+class BlockedBloomfilter(Bloomfilter):
+    def __init__(self, *args, **kwargs):
+        """A cache friendly Bloom filter. The first hash picks a block of
+        `BLOCK_BITS` (a 64 byte cache line) and all of an item's positions
+        fall within that block, so a lookup touches a single cache line
+        instead of `num_hashes` random ones. This comes at the cost of a
+        slightly higher false positive rate. Takes the same arguments as
+        `Bloomfilter`.
+
+        Reference material:
+        http://algo2.iti.kit.edu/documents/cacheefficientbloomfilters-jea.pdf
+        """
+        super(BlockedBloomfilter, self).__init__(*args, **kwargs)
+
+    _flags = FLAG_BLOCKED
+
+    def _configure(self, *args):
+        super(BlockedBloomfilter, self)._configure(*args)
+        self.num_blocks = -(-self.hashbits // BLOCK_BITS)
+        self.hashbits = self.num_blocks * BLOCK_BITS
+
+        # One odd multiplier per hash (multiply-shift hashing)
+        self._salts = [_fmix64(i + 1) | 1 for i in range(self.num_hashes)]
+
+    def _positions(self, h1, h2):
+        # The top bits of each (64-bit) product of h2 and a salt give a
+        # position within the block
+        base = (h1 % self.num_blocks) * BLOCK_BITS
+        shift = 64 - (BLOCK_BITS - 1).bit_length()
+        return [
+            base + (((h2 * salt) & MASK64) >> shift) for salt in self._salts]
+
+    def _position_array(self, digests):
+        base = digests[:, 0] % np.uint64(self.num_blocks)
+        base *= np.uint64(BLOCK_BITS)
+        shift = np.uint64(64 - (BLOCK_BITS - 1).bit_length())
+        salts = np.array(self._salts, dtype=np.uint64)
+        in_block = (digests[:, 1, None] * salts[None, :]) >> shift
+        return base[:, None] + in_block
+
+
+class ConcurrentBloomfilter(Bloomfilter):
+    def __init__(self, *args, stripes=DEF_STRIPES, **kwargs):
+        """A Bloom filter that many threads can add to (and check) at once.
+
+        Setting a bit is a read-modify-write of a byte, so the bytes are
+        divided among 'stripes' locks (byte i is guarded by lock
+        i % stripes) and only the lock for each byte being set is held.
+        Lookups only read, so they don't need a lock. The remaining
+        arguments are the same as for `Bloomfilter`.
+        """
+        self.stripes = stripes
+        super(ConcurrentBloomfilter, self).__init__(*args, **kwargs)
+
+    stripes = DEF_STRIPES
+
+    def _configure(self, *args):
+        super(ConcurrentBloomfilter, self)._configure(*args)
+        self._locks = [Lock() for _ in range(self.stripes)]
+        self._count_lock = Lock()
+
+    def _incr_count(self, num):
+        with self._count_lock:
+            self.count += num
+
+    def _set_bits(self, positions):
+        bits, locks, stripes = self.bits, self._locks, self.stripes
+
+        for pos in positions:
+            with locks[(pos >> 3) % stripes]:
+                bits[pos >> 3] |= 1 << (pos & 7)
+
+    def _set_array(self, indices):
+        view = np.frombuffer(self.bits, dtype=np.uint8)
+        indices = indices.ravel()
+        positions = indices >> np.uint64(3)
+        values = np.left_shift(np.uint64(1), indices & np.uint64(7))
+        values = values.astype(np.uint8)
+
+        # Group the positions by stripe so each lock is only taken once
+        stripes = positions % np.uint64(self.stripes)
+        order = np.argsort(stripes, kind='stable')
+        positions, values, stripes = (
+            positions[order], values[order], stripes[order])
+
+        bounds = np.searchsorted(stripes, np.arange(self.stripes + 1))
+
+        for stripe, (start, end) in enumerate(pairwise(bounds.tolist())):
+            if start < end:
+                with self._locks[stripe]:
+                    np.bitwise_or.at(
+                        view, positions[start:end], values[start:end])
+
+    def __getstate__(self):
+        return super(ConcurrentBloomfilter, self).__getstate__(), self.stripes
+
+    def __setstate__(self, state):
+        data, self.stripes = state
+        super(ConcurrentBloomfilter, self).__setstate__(data)
 
-        for pos in self._hashes(name):
-            retval = retval and bool(self.hash & (2 ** pos))
+    def _merge(self, *args):
+        with ExitStack() as stack:
+            for lock in self._locks:
+                stack.enter_context(lock)
 
-        return retval
+            return super(ConcurrentBloomfilter, self)._merge(*args)
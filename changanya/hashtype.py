@@ -6,17 +6,280 @@ Base class from which hash types can be created.
 
 Part of changanya by reubano. See README and LICENSE.
 """
+import itertools as it
+
+from array import array
 from functools import total_ordering
+from math import factorial
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 DEF_HASHBITS = 96
+PACKED_HASHBITS = 64
+BATCH_SIZE = 2 ** 16
+
+try:
+    popcount = int.bit_count
+except AttributeError:
+    def popcount(x):
+        "Number of set bits in a (non-negative) integer"
+        return bin(x).count('1')
+
+try:
+    from math import comb
+except ImportError:
+    def comb(n, k):
+        "Number of ways to choose 'k' of 'n' items (0 if 'k' exceeds 'n')"
+        if not 0 <= k <= n:
+            return 0
+
+        return factorial(n) // (factorial(k) * factorial(n - k))
+
+
+def popcount_array(values):
+    "Number of set bits in each element of a numpy uint64 array (as uint8)"
+    values = np.asarray(values, dtype=np.uint64)
+
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(values)
+
+    # Sum the set bits of each byte (numpy < 2.0 has no bitwise_count)
+    as_bytes = values.reshape(-1, 1).view(np.uint8)
+    bits = np.unpackbits(as_bytes, axis=1).sum(axis=1, dtype=np.uint8)
+    return bits.reshape(values.shape)
+
+
+def _packed(hashes):
+    "A numpy view of packed hashes (or None if they aren't packed)"
+    if np is None:
+        return None
+    elif isinstance(hashes, HashArray):
+        return hashes.packed
+    elif isinstance(hashes, array) and hashes.typecode == 'Q':
+        return np.frombuffer(hashes, dtype=np.uint64)
+    elif isinstance(hashes, memoryview) and hashes.format == 'Q':
+        return np.frombuffer(hashes, dtype=np.uint64)
+    elif isinstance(hashes, np.ndarray) and (
+            hashes.dtype == np.uint64 and hashes.ndim == 1 or
+            hashes.dtype == np.uint8 and hashes.ndim == 2):
+        return hashes
+
+
+def _packed_query(query, packed):
+    "A query hash (or Hashtype object) in the same format as packed hashes"
+    _hash = getattr(query, 'hash', query)
+
+    if packed.dtype == np.uint64:
+        return np.uint64(_hash)
+    else:
+        as_bytes = _hash.to_bytes(packed.shape[1], 'little')
+        return np.frombuffer(as_bytes, dtype=np.uint8)
+
+
+def _distances(xored):
+    "The hamming distances of xor-ed packed hashes (the last axis is bytes)"
+    if xored.dtype == np.uint64:
+        return popcount_array(xored)
+    elif hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(xored).sum(axis=-1, dtype=np.uint16)
+    else:
+        counts = np.unpackbits(xored[..., None], axis=-1)
+        return counts.sum(axis=(-2, -1), dtype=np.uint16)
+
+
+def hamming_many(query, hashes):
+    """The hamming distance between a hash (or Hashtype object) and each of
+    many hashes. 'hashes' is either packed, i.e., a `HashArray`, a numpy
+    uint64 array (or `array('Q')` or memoryview), or a 2-d numpy uint8
+    array with a row of little endian bytes per hash (e.g.,
+    `h.to_bytes(32, 'little')` for 256 bit hashes), and the result is a
+    numpy array, or it is any other iterable of hashes (or Hashtype
+    objects), and the result is a list.
+    """
+    packed = _packed(hashes)
+
+    if packed is None:
+        # `popcount` may be `int.bit_count`, which rejects numpy integers
+        _hash = int(getattr(query, 'hash', query))
+        return [popcount(_hash ^ int(getattr(h, 'hash', h))) for h in hashes]
+
+    return _distances(packed ^ _packed_query(query, packed))
+
+
+def pairwise_hamming(hashes, others=None):
+    """The matrix of hamming distances between each of 'hashes' (the rows)
+    and each of 'others' (the columns, defaults to 'hashes'). If both are
+    packed (see `hamming_many`), the result is a numpy array, otherwise it
+    is a list of lists. The rows are computed in batches, but the result
+    is still quadratic, so split large collections into blocks of rows.
+    """
+    others = hashes if others is None else others
+    packed, packed_others = _packed(hashes), _packed(others)
+
+    if packed is None or packed_others is None:
+        others = [int(getattr(h, 'hash', h)) for h in others]
+        return [hamming_many(_hash, others) for _hash in hashes]
+
+    # Limit the size of each batch's xor-ed hashes
+    row_size = packed_others.nbytes or 1
+    step = max(1, BATCH_SIZE * 2 ** 8 // row_size)
+
+    return np.concatenate([
+        _distances(packed[i:i + step, None] ^ packed_others[None])
+        for i in range(0, len(packed) or 1, step)])
+
+
+def chunked(iterable, size=BATCH_SIZE):
+    "Split an iterable into lists of (at most) `size` items"
+    iterator = iter(iterable)
+    chunk = list(it.islice(iterator, size))
+
+    while chunk:
+        yield chunk
+        chunk = list(it.islice(iterator, size))
+
+
+def pairwise(iterable):
+    "Yield each overlapping pair of consecutive items"
+    a, b = it.tee(iterable)
+    next(b, None)
+    return zip(a, b)
+
+
+def _count(hashes, width):
+    "The number of hashes in an `array('Q')` or a buffer of 'width' bytes"
+    return len(hashes) if type(hashes) == array else len(hashes) // width
+
+
+class HashArray(object):
+    """A column of fixed width hashes (and optionally their integer ids).
+
+    Hashes of (at most) 64 bits are stored in an `array('Q')`, and wider
+    ones as little endian bytes in a `bytearray`, so each hash costs 8 (or
+    `width`) bytes instead of a whole Hashtype object. `SimhashIndex`,
+    `hamming_many`, and `pairwise_hamming` accept them directly.
+    """
+    __slots__ = ('hashbits', 'width', 'hashes', 'ids')
+
+    def __init__(self, hashes=(), hashbits=PACKED_HASHBITS, ids=None):
+        """
+        'hashes' is an iterable of Hashtype objects or hash values (or any
+        packed hashes accepted by `hamming_many`), and 'ids' an optional
+        iterable of their (integer) ids.
+        """
+        self.hashbits = hashbits
+
+        if hashbits <= PACKED_HASHBITS:
+            self.width = 8
+            self.hashes = array('Q')
+        else:
+            self.width = -(-hashbits // 8)
+            self.hashes = bytearray()
+
+        self.ids = None
+        self.extend(hashes, ids)
+
+    def __len__(self):
+        return _count(self.hashes, self.width)
+
+    def __getitem__(self, row):
+        if type(self.hashes) == array:
+            return self.hashes[row]
+
+        start = range(len(self))[row] * self.width
+        return int.from_bytes(self.hashes[start:start + self.width], 'little')
+
+    def __iter__(self):
+        if type(self.hashes) == array:
+            return iter(self.hashes)
+
+        width, hashes = self.width, self.hashes
+        return (
+            int.from_bytes(hashes[start:start + width], 'little')
+            for start in range(0, len(hashes), width))
+
+    @property
+    def packed(self):
+        """A numpy view of the hashes (uint64, or a row of uint8 bytes per
+        hash). The array can't grow while a view of it exists.
+        """
+        if type(self.hashes) == array:
+            return np.frombuffer(self.hashes, dtype=np.uint64)
+
+        as_bytes = np.frombuffer(self.hashes, dtype=np.uint8)
+        return as_bytes.reshape(-1, self.width)
+
+    def _pack(self, hashes):
+        "Pack Hashtype objects (or hash values) like the hashes"
+        if isinstance(hashes, HashArray):
+            if hashes.hashbits != self.hashbits:
+                raise ValueError('Hashes must be of equal size to be added')
+
+            return hashes.hashes
+
+        packed = _packed(hashes)
+
+        if type(self.hashes) == array:
+            if packed is not None and packed.dtype == np.uint64:
+                as_array = array('Q')
+                as_array.frombytes(packed.tobytes())
+                return as_array
+
+            return array('Q', (getattr(h, 'hash', h) for h in hashes))
+        elif packed is not None and packed.shape[1:] == (self.width,):
+            return packed.tobytes()
+        else:
+            return b''.join(
+                getattr(h, 'hash', h).to_bytes(self.width, 'little')
+                for h in hashes)
+
+    def append(self, _hash, _id=None):
+        "Add a Hashtype object (or hash value) and its id"
+        self.extend([_hash], None if _id is None else [_id])
+
+    def extend(self, hashes, ids=None):
+        """Add many Hashtype objects (or hash values) and their ids (which
+        default to those of a `HashArray`)
+        """
+        if ids is None and isinstance(hashes, HashArray):
+            ids = hashes.ids
+
+        packed = self._pack(hashes)
+        count = _count(packed, self.width)
+
+        if ids is not None:
+            ids = array('q', ids)
+
+            if len(ids) != count:
+                raise ValueError('Expected %i ids, got %i' % (count, len(ids)))
+            elif self.ids is None and len(self):
+                raise ValueError('These hashes have no ids')
+            elif self.ids is None:
+                self.ids = array('q')
+        elif self.ids is not None and count:
+            raise ValueError('These hashes require ids')
+
+        self.hashes.extend(packed)
+
+        if ids is not None:
+            self.ids.extend(ids)
 
 
 @total_ordering
 class Hashtype(object):
+    __slots__ = ('hashbits', 'hash')
+
     def __init__(self, hashbits=DEF_HASHBITS):
         self.hashbits = hashbits
         self.hash = None
 
+    @property
+    def hashtype(self):
+        return type(self)
+
     def __hash__(self):
         return self.hash
 
@@ -45,24 +308,18 @@ class Hashtype(object):
         return hex(int(self.hash))
 
     def hamming_distance(self, other):
-        x = (self.hash ^ other.hash) & ((1 << self.hashbits) - 1)
-        tot = 0
-
-        while x:
-            tot += 1
-            x &= x - 1
-
-        return tot
+        return popcount((self.hash ^ other.hash) & ((1 << self.hashbits) - 1))
 
     def similarity(self, other_hash):
         """Calculate how similar this hash is from another hash.
         Returns a float from 0.0 to 1.0 (linear distribution, inclusive)
         """
-        if type(other_hash) != self.hashtype:
-            raise TypeError('Hashes must be of same type to find similarity')
+        hashbits = self.hashbits
 
-        if self.hashbits != other_hash.hashbits:
+        if type(other_hash) is not type(self):
+            raise TypeError('Hashes must be of same type to find similarity')
+        elif hashbits != other_hash.hashbits:
             raise ValueError('Hashes must be of equal size to find similarity')
 
-        numerator = self.hashbits - self.hamming_distance(other_hash)
-        return numerator / self.hashbits
+        x = (self.hash ^ other_hash.hash) & ((1 << hashbits) - 1)
+        return (hashbits - popcount(x)) / hashbits
@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+# vim: sw=4:ts=4:expandtab
+
+"""
+A multi-probe, bit sampling LSH index of Charikar similarity hashes.
+
+`SimhashIndex` guarantees every duplicate is found, but needs more than
+`bits` blocks, so large thresholds (e.g., 6-10 bits of 64) are impractical.
+`LSHIndex` instead trades a (tunable) fraction of the duplicates for speed.
+
+Part of changanya by reubano. See README and LICENSE.
+"""
+import itertools as it
+
+from random import Random
+
+from changanya.hashtype import comb
+from changanya.simhash import BaseIndex, np
+
+DEF_SEED = 0
+
+
+class LSHIndex(BaseIndex):
+    def __init__(
+            self, simhashes, bits=8, num_tables=16, sample_bits=16,
+            probe_bits=1, compact=False, hashbits=None, purge_ratio=None,
+            seed=DEF_SEED):
+        """
+        'simhashes' is a list of Simhash objects (or hash values) and 'bits'
+        is the maximum number of bits in which duplicates may differ.
+
+        Each of the 'num_tables' tables keys the hashes by 'sample_bits'
+        randomly chosen bits. Queries also probe the keys that differ from
+        theirs in (at most) 'probe_bits' bits. More tables or probes raise
+        the recall (see `recall`) at the cost of more candidates. More
+        sample bits lower both. 'seed' picks the sampled bits, so indexes
+        with the same seed (and sizes) have the same tables.
+
+        The other arguments (and the query and update methods) are the
+        same as those of `SimhashIndex`. `find_all_dupes` (and `clusters`)
+        find the duplicates of every indexed hash, and `nearest` scans all
+        of the hashes (so it is exact). Unlike `SimhashIndex`, it can't be
+        tuned, saved, or loaded.
+        """
+        self.sample_bits = sample_bits
+        self.probe_bits = probe_bits
+        self.seed = seed
+
+        super(LSHIndex, self).__init__(
+            simhashes, hashbits, purge_ratio, bits, num_tables, compact)
+
+    def _configure(self, hashbits, bits, num_tables, compact):
+        if self.sample_bits > hashbits:
+            raise ValueError('Sample bits must not exceed %i' % hashbits)
+
+        self.hashbits = hashbits
+        self.bits = bits
+        self.num_tables = num_tables
+        self.compact = compact
+        self.purge_ratio = None
+        self.purged = 0
+        self.tables = None
+
+        random = Random(self.seed)
+        hash_range = range(hashbits)
+        self.positions = [
+            sorted(random.sample(hash_range, self.sample_bits))
+            for _ in range(num_tables)]
+
+        # The key masks to probe, fewest flipped bits first
+        sample_range = range(self.sample_bits)
+        self.probes = [
+            sum(1 << position for position in positions)
+            for flips in range(self.probe_bits + 1)
+            for positions in it.combinations(sample_range, flips)]
+
+        # The (partial) keys of each byte value of each byte of a hash
+        num_bytes = -(-hashbits // 8)
+        self.lookups = [
+            [self._byte_keys(positions, 8 * i) for i in range(num_bytes)]
+            for positions in self.positions]
+
+    @staticmethod
+    def _byte_keys(positions, shift):
+        "The (partial) key of each value of the byte at 'shift'"
+        byte_keys = [0]
+
+        # Each bit doubles the table (the new half has that bit set)
+        for bit in range(shift, shift + 8):
+            weight = sum(
+                1 << i for i, position in enumerate(positions)
+                if position == bit)
+
+            byte_keys += [key | weight for key in byte_keys]
+
+        return byte_keys
+
+    def recall(self, distance):
+        """The probability that a hash 'distance' bits away is a candidate,
+        i.e., the expected recall of duplicates that far apart
+        """
+        hashbits, sample_bits = self.hashbits, self.sample_bits
+
+        # The sampled bits are distinct, so the number of them that differ
+        # is hypergeometric
+        ways = sum(
+            comb(distance, flips) *
+            comb(hashbits - distance, sample_bits - flips)
+            for flips in range(self.probe_bits + 1))
+
+        table = ways / comb(hashbits, sample_bits)
+        return 1 - (1 - table) ** self.num_tables
+
+    def get_keys(self, simhash):
+        "The bucket keys of a Simhash object (or hash value)"
+        _hash = getattr(simhash, 'hash', simhash)
+        values = [_hash >> shift & 255 for shift in range(0, self.hashbits, 8)]
+
+        for table, lookups in enumerate(self.lookups):
+            key = 0
+
+            for byte_keys, value in zip(lookups, values):
+                key |= byte_keys[value]
+
+            yield key * self.num_tables + table
+
+    def _key_array(self, hashes):
+        """The bucket keys of a numpy uint64 array of hashes (all of the
+        first table's keys, then the second's, ...)
+        """
+        byte_range = np.arange(len(self.lookups[0]))
+        values = hashes.astype('<u8').view(np.uint8).reshape(len(hashes), -1)
+        values = values[:, :len(byte_range)]
+        num_tables = np.uint64(self.num_tables)
+        keys = []
+
+        for table, lookups in enumerate(self.lookups):
+            byte_keys = np.array(lookups, dtype=np.uint64)
+            key = np.bitwise_or.reduce(byte_keys[byte_range, values], axis=1)
+            keys.append(key * num_tables + np.uint64(table))
+
+        return np.concatenate(keys)
+
+    def _candidate_runs(self, _hash):
+        "Yields the buckets of each table's key and its probes"
+        bucket = self.bucket
+
+        for key in self.get_keys(_hash):
+            table_key, table = divmod(key, self.num_tables)
+
+            for probe in self.probes:
+                probe_key = (table_key ^ probe) * self.num_tables + table
+
+                if probe_key in bucket:
+                    yield bucket[probe_key]
@@ -40,14 +40,18 @@ DEF_HASHBITS = 256
 
 
 class Nilsimsa(Hashtype):
+    __slots__ = ('count', 'acc', 'last')
+
     def __init__(self, data='', hashbits=DEF_HASHBITS):
-        self.hashtype = Nilsimsa
         super(Nilsimsa, self).__init__(hashbits)
         self.count = 0                  # num characters seen
         self.acc = [0] * self.hashbits  # accumulators for computing digest
         self.last = [-1] * 4            # last four seen chars (-1 until set)
         self.hash = self.create_hash(data)
 
+        # The digest is done, so release the working state
+        self.acc = self.last = None
+
     def _tran3(self, a, b, c, n):
         """Get accumulator for a transition n between chars a, b, c."""
         multiple = (n + n + 1)
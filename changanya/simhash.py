@@ -11,45 +11,263 @@ Part of changanya by reubano. See README and LICENSE.
 """
 import itertools as it
 
-from collections import defaultdict
-from operator import attrgetter
-from functools import reduce
+from array import array
+from collections import Counter, deque
+from concurrent.futures import (
+    FIRST_COMPLETED, ProcessPoolExecutor, as_completed, wait)
+from heapq import nsmallest
+from operator import itemgetter, or_, xor
+from functools import lru_cache, reduce
+from mmap import ACCESS_READ, mmap as memory_map
+from random import Random
+from struct import Struct
+from time import monotonic
 
-from changanya.hashtype import Hashtype
+from changanya.hashtype import (
+    HashArray, Hashtype, chunked, comb, hamming_many, pairwise, popcount,
+    popcount_array)
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+try:
+    from multiprocessing.shared_memory import SharedMemory
+except ImportError:
+    SharedMemory = None
 
 DEF_HASHBITS = 64
+DOC_BATCH_SIZE = 2 ** 10
+DEF_CACHE_SIZE = 2 ** 16
+DEF_SAMPLE_SIZE = 2 ** 13
+SAMPLE_TABLES = 2 ** 5
+
+# The approximate memory used by each bucket (excluding its rows)
+BUCKET_BYTES = 160
+
+# magic, version, hashbits, bits, num_blocks, length, purged (padded to 64)
+_HEADER = Struct('<4sHHHHQQ36x')
+MAGIC = b'CSHI'
+VERSION = 1
+
+
+def string_hash(v, hashbits=DEF_HASHBITS):
+    "A variable-length version of Python's builtin hash. Neat!"
+    if v == '':
+        return 0
+    else:
+        x = ord(v[0]) << 7
+        m = 1000003
+        mask = (1 << hashbits) - 1
+
+        for c in v:
+            x = ((x * m) ^ ord(c)) & mask
+
+        x ^= len(v)
+
+        if x == -1:
+            x = -2
+
+        return x
+
+
+_token_hash = string_hash
+
+
+def enable_token_cache(maxsize=DEF_CACHE_SIZE):
+    """Memoize token hashes in an LRU cache of (at most) 'maxsize' entries
+    shared by all Simhash objects (and `simhash_many`). Since word
+    frequencies are Zipfian, even a small cache skips most of the hashing.
+    The cache is keyed on (token, hashbits). Calling this again replaces
+    (and empties) the existing cache.
+    """
+    global _token_hash
+    _token_hash = lru_cache(maxsize=maxsize)(string_hash)
+
+
+def disable_token_cache():
+    "Stop caching token hashes (and drop the cache)"
+    global _token_hash
+    _token_hash = string_hash
+
+
+def token_cache_info():
+    """The hits, misses, maxsize, and currsize of the token hash cache, or
+    None if the cache is disabled.
+    """
+    cache_info = getattr(_token_hash, 'cache_info', None)
+    return cache_info() if cache_info else None
+
+
+def _tokenize(data):
+    return data.split() if type(data) == str else data
+
 
+def _simhash_batch(documents, hashbits):
+    """Simhash a batch of documents with numpy. Returns a (len(documents),
+    hashbits) boolean array of the hash bits (least significant first).
+    """
+    num_words = -(-hashbits // 64)
+    hashes, starts, empty, weights = bytearray(), [], [], []
+    weighted = False
 
-def pairwise(iterable):
-    a, b = it.tee(iterable)
-    next(b, None)
-    return zip(a, b)
+    for i, document in enumerate(documents):
+        start = len(hashes) // (8 * num_words)
+
+        for token in _tokenize(document):
+            if type(token) == tuple:
+                token, weight = token
+                weighted = True
+            else:
+                weight = 1
+
+            weights.append(weight)
+            _hash = _token_hash(token, hashbits)
+            hashes += _hash.to_bytes(8 * num_words, 'little')
+
+        if len(hashes) // (8 * num_words) == start:
+            empty.append(i)
+        else:
+            starts.append(start)
+
+    # Bit j of a token hash is element j of its row
+    as_bytes = np.frombuffer(hashes, dtype=np.uint8).reshape(-1, 8 * num_words)
+    bits = np.unpackbits(as_bytes, axis=1, bitorder='little')[:, :hashbits]
+    weights = np.array(weights) if weighted else np.ones(len(bits), np.int64)
+    ones = np.zeros((len(documents), hashbits), dtype=weights.dtype)
+    lengths = np.zeros(len(documents), dtype=weights.dtype)
+
+    if starts:
+        non_empty = np.delete(np.arange(len(documents)), empty)
+        lengths[non_empty] = np.add.reduceat(weights, starts)
+
+        if weighted:
+            ones[non_empty] = np.add.reduceat(
+                bits * weights[:, None], starts, axis=0)
+        else:
+            ones[non_empty] = np.add.reduceat(
+                bits, starts, axis=0, dtype=np.int64)
+
+    # Each token adds its weight to the votes of its set bits and subtracts
+    # it from those of its unset bits, so a bit is set if its set tokens
+    # weigh at least half the total
+    return 2 * ones >= lengths[:, None]
+
+
+def simhash_many(documents, hashbits=DEF_HASHBITS, as_array=False):
+    """Calculate the simhashes of an iterable of documents (strings or
+    iterables of tokens or (token, weight) pairs), vectorizing the per-bit
+    voting with numpy (if it is installed). The results are identical to
+    `Simhash(document)`.
+
+    Returns a list of Simhash objects, or if 'as_array' is True (requires
+    numpy and hashbits <= 64), a numpy uint64 array of the hashes.
+    """
+    if as_array and (np is None or hashbits > 64):
+        raise ValueError('as_array requires numpy and hashbits <= 64')
+    elif np is None:
+        return [Simhash(document, hashbits) for document in documents]
+
+    num_bytes = -(-hashbits // 64) * 8
+    packed = []
+
+    for chunk in chunked(documents, DOC_BATCH_SIZE):
+        bits = _simhash_batch(chunk, hashbits)
+        padding = ((0, 0), (0, num_bytes * 8 - hashbits))
+        padded = np.pad(bits, padding)
+        packed.append(np.packbits(padded, axis=1, bitorder='little'))
+
+    if not packed:
+        packed = [np.zeros((0, num_bytes), dtype=np.uint8)]
+
+    packed = np.concatenate(packed)
+
+    if as_array:
+        return packed.view('<u8').ravel().astype(np.uint64)
+
+    return [
+        Simhash.from_hash(int.from_bytes(row, 'little'), hashbits)
+        for row in map(bytes, packed)]
 
 
 class Simhash(Hashtype):
-    def __init__(self, data, hashbits=DEF_HASHBITS):
-        self.hashtype = Simhash
+    __slots__ = ('votes',)
+
+    def __init__(self, data=None, hashbits=DEF_HASHBITS):
+        """
+        'data' is a string (which is split into words), or an iterable of
+        tokens or (token, weight) pairs. The votes of a hash created from
+        'data' are released once it is computed. To hash a stream in
+        pieces, omit 'data', call `update` with each piece, and then call
+        `finalize`.
+        """
         super(Simhash, self).__init__(hashbits)
-        self.hash = self.create_hash(data)
+        self.votes = [0] * hashbits
+
+        if data is not None:
+            self.hash = self.create_hash(data)
+            self.votes = None
+
+    @classmethod
+    def from_hash(cls, _hash, hashbits=DEF_HASHBITS):
+        "Create a Simhash object from an existing hash value"
+        simhash = cls.__new__(cls)
+        Hashtype.__init__(simhash, hashbits)
+        simhash.hash = _hash
+        simhash.votes = None
+        return simhash
 
     def _string_hash(self, v):
-        "A variable-length version of Python's builtin hash. Neat!"
-        if v == '':
-            return 0
-        else:
-            x = ord(v[0]) << 7
-            m = 1000003
-            mask = 2 ** self.hashbits - 1
+        return _token_hash(v, self.hashbits)
 
-            for c in v:
-                x = ((x * m) ^ ord(c)) & mask
+    def update(self, data):
+        """Add more tokens (or (token, weight) pairs) to the running vote
+        vector. Call `finalize` to (re)compute the hash afterwards.
+        """
+        if self.votes is None:
+            raise ValueError('This Simhash has no votes to update')
 
-            x ^= len(v)
+        weights = Counter()
 
-            if x == -1:
-                x = -2
+        for token in _tokenize(data):
+            if type(token) == tuple:
+                token, weight = token
+            else:
+                weight = 1
 
-            return x
+            weights[self._string_hash(token)] += weight
+
+        # Each token adds its weight to the votes of its set bits and
+        # subtracts it from the votes of its unset bits
+        votes = self.votes
+
+        for t, weight in weights.items():
+            for i in range(self.hashbits):
+                votes[i] += weight if t >> i & 1 else -weight
+
+    def merge(self, other):
+        """Add the votes of another (unfinalized) Simhash to this one, e.g.,
+        to combine the hashes of multiple documents. Call `finalize` to
+        (re)compute the hash afterwards.
+        """
+        if self.hashbits != other.hashbits:
+            raise ValueError('Hashes must be of equal size to be merged')
+        elif self.votes is None or other.votes is None:
+            raise ValueError('Both Simhashes must have votes to be merged')
+
+        self.votes = [x + y for x, y in zip(self.votes, other.votes)]
+
+    def finalize(self):
+        "Compute the hash from the current votes. Returns the hash."
+        _hash = 0
+
+        for i, vote in enumerate(self.votes):
+            if vote >= 0:
+                _hash += 1 << i
+
+        self.hash = _hash
+        return _hash
 
     def create_hash(self, data):
         """Calculates a Charikar simhash with appropriate bitlength.
@@ -60,155 +278,1133 @@ class Simhash(Hashtype):
 
         Reference used: http://dsrg.mff.cuni.cz/~holub/sw/shash
         """
-        tokens = data.split() if type(data) == str else data
-        v = [0] * self.hashbits
+        self.votes = [0] * self.hashbits
+        self.update(data)
+        return self.finalize()
 
-        for t in [self._string_hash(x) for x in tokens]:
-            bitmask = 0
 
-            for i in range(self.hashbits):
-                bitmask = 1 << i
-                v[i] += 1 if t & bitmask else -1
+def _table_runs(hashes, mask):
+    """Yields the runs (of at least two rows) of 'hashes' with equal 'mask'
+    bits. 'hashes' is a sequence of ints or (with numpy) packed uint64
+    hashes, or a 2-d numpy uint8 array of (little endian) wider ones.
+    """
+    if np is None or type(hashes) == list:
+        key = lambda row: hashes[row] & mask
+        order = sorted(range(len(hashes)), key=key)
 
-        _hash = 0
+        for _, group in it.groupby(order, key):
+            run = list(group)
 
-        for i in range(self.hashbits):
-            if v[i] >= 0:
-                _hash += 1 << i
+            if len(run) > 1:
+                yield run
 
-        return _hash
+        return
+    elif isinstance(hashes, np.ndarray):
+        width = hashes.shape[1]
+        mask_bytes = np.frombuffer(mask.to_bytes(width, 'little'), np.uint8)
 
+        # Equal keys only need to be adjacent, so compare them as raw bytes
+        keys = np.ascontiguousarray(hashes & mask_bytes)
+        keys = keys.view(np.dtype((np.void, width))).ravel()
+    else:
+        keys = np.frombuffer(hashes, dtype=np.uint64) & np.uint64(mask)
 
-# https://github.com/seomoz/simhash-cpp/blob/master/src/permutation.cpp
-# https://moz.com/devblog/near-duplicate-detection/
-class Permuter(object):
-    def __init__(self, bits, masks, widths, hashbits=DEF_HASHBITS):
-        self.bits = bits
-        self.masks = masks
-        self.hashbits = hashbits
-        self.widths = widths
+    order = np.argsort(keys, kind='stable')
+    keys = keys[order]
+    bounds = np.flatnonzero(keys[1:] != keys[:-1]) + 1
+    bounds = [0] + bounds.tolist() + [len(keys)]
 
-        width_range = range(len(widths))
-        self.offsets = [
-            self.hashbits - sum(self.widths[:i + 1]) - 1 for i in width_range]
-
-    @property
-    def search_mask(self):
-        # Alright, we have to determine the low and high masks for this
-        # particular table. If we are searching for up to `bits` differing bits,
-        # then we should  include all but the last `bits` blocks in our mask.
-        width = sum(self.widths[:-self.bits])
-
-        # Set the first /width/ bits in the low mask to 1, and then shift it up
-        # until it's a full bit number.
-        _search_mask = reduce(lambda x, y: (x << 1) | 1, range(width), 0)
-        reducer = lambda x, y: x << 1
-        return reduce(reducer, range(self.hashbits - width), _search_mask)
-
-    def permute(self, _hash):
-        def reducer(x, y):
-            mask, offset = y
-
-            if offset > 0:
-                return x | ((_hash & mask) << offset)
+    for start, end in pairwise(bounds):
+        if end - start > 1:
+            yield order[start:end].tolist()
+
+
+def _table_dupes(hashes, mask, kept, blocks, bits):
+    """Yields the (row, row) pairs of duplicates in the table of 'hashes'
+    (see `_table_runs`) sorted by 'mask' (the 'kept' blocks). A pair can
+    match in many tables, but is only yielded by the first one (in
+    `itertools.combinations` order), i.e., the one whose kept blocks are
+    the first blocks the pair shares.
+    """
+    num_kept = len(kept)
+
+    if np is not None and isinstance(hashes, np.ndarray):
+        value = lambda row: int.from_bytes(hashes[row].tobytes(), 'little')
+    else:
+        value = hashes.__getitem__
+
+    # Walk every run of rows with equal kept blocks
+    for run in _table_runs(hashes, mask):
+        for row, other in it.combinations(run, 2):
+            diff = value(row) ^ value(other)
+
+            if popcount(diff) <= bits:
+                shared = [
+                    i for i, block in enumerate(blocks) if not diff & block]
+
+                if tuple(shared[:num_kept]) == kept:
+                    yield (row, other)
+
+
+def _search(rows, key, value):
+    "The slice of 'rows' (sorted by 'key') whose key equals 'value'"
+    lo, hi = 0, len(rows)
+
+    while lo < hi:
+        mid = (lo + hi) // 2
+
+        if key(rows[mid]) < value:
+            lo = mid + 1
+        else:
+            hi = mid
+
+    start, hi = lo, len(rows)
+
+    while lo < hi:
+        mid = (lo + hi) // 2
+
+        if key(rows[mid]) > value:
+            hi = mid
+        else:
+            lo = mid + 1
+
+    return rows[start:lo]
+
+
+def _shared_table_dupes(name, length, width, *args):
+    """Run `_table_dupes` on the ('width' byte) hashes in a shared memory
+    block (in a worker process). Returns the flattened pairs of rows.
+    """
+    shm = SharedMemory(name)
+
+    try:
+        with shm.buf[:length * width] as buf:
+            if width == 8:
+                with buf.cast('Q') as hashes:
+                    flat = array('q', it.chain.from_iterable(
+                        _table_dupes(hashes, *args)))
             else:
-                return x | ((_hash & mask) >> -offset)
+                # A view of the buffer (which must be gone before it closes)
+                hashes = np.frombuffer(buf, dtype=np.uint8)
+                flat = array('q', it.chain.from_iterable(
+                    _table_dupes(hashes.reshape(length, width), *args)))
+
+                del hashes
+    finally:
+        shm.close()
+
+    return flat
+
 
-        return reduce(reducer, zip(self.masks[1:], self.offsets), 0)
+def _completed_pairs(futures):
+    "Yields the pairs of rows flattened by each (completed) future"
+    for future in futures:
+        flat = future.result()
+
+        for pair in zip(flat[::2], flat[1::2]):
+            yield pair
 
 
 # http://leons.im/posts/a-python-implementation-of-simhash-algorithm/
-class SimhashIndex(object):
-    def __init__(self, simhashes, bits=2, num_blocks=6):
-        self.simhashes = simhashes
-        self.hashbits = simhashes[0].hashbits
+class BaseIndex(object):
+    def __init__(self, simhashes, hashbits=None, purge_ratio=None, *args):
+        """
+        The storage, mutation, and query methods shared by the indexes of
+        Simhash objects. Subclasses define how the hashes are keyed into
+        buckets (`_configure`, with 'hashbits' and 'args', `get_keys`, and
+        `_key_array`). 'hashbits' defaults to that of the first simhash (or
+        the `HashArray`). See `SimhashIndex` for the other arguments.
+        """
+        if hashbits is None and isinstance(simhashes, HashArray):
+            hashbits = simhashes.hashbits
+        elif hashbits is None:
+            hashbits = simhashes[0].hashbits
+
+        self._configure(hashbits, *args)
+        self.purge_ratio = purge_ratio
+        self._reset()
+        self.extend(simhashes)
+
+    def _reset(self):
+        # Use packed (unsigned 64-bit) arrays when the hashes fit
+        self.hashes = array('Q') if self.hashbits <= 64 else []
+        self.ids = array('q')
+        self.simhashes = None if self.compact else []
+        self.bucket = {}
+        self.removed = set()
+        self._id_rows = None
+
+        # Ids above it are new (and don't need the map of ids to rows)
+        self._max_id = float('-inf')
+
+    def __len__(self):
+        return len(self.hashes) - len(self.removed)
+
+    def _entry(self, row):
+        if self.compact:
+            return Simhash.from_hash(self.hashes[row], self.hashbits)
+        else:
+            return self.simhashes[row]
+
+    def add(self, simhash, doc_id=None):
+        """Add a Simhash object (or hash value) to the index. 'doc_id' is
+        an (integer) document id and defaults to the row number. Raises a
+        ValueError if another document in the index has the same id.
+        """
+        if self.tables is not None:
+            self.purge()
+
+        self._bucket_row(*self._append(simhash, doc_id))
+
+    def _append(self, simhash, doc_id):
+        "Append a row to the columns. Returns its row number and hash."
+        if hasattr(simhash, 'hash'):
+            self._check_hashbits(simhash)
+            _hash = simhash.hash
+        else:
+            _hash = simhash
+            simhash = None if self.compact else Simhash.from_hash(
+                _hash, self.hashbits)
+
+        row = len(self.hashes)
+        doc_id = row + self.purged if doc_id is None else doc_id
+
+        if doc_id <= self._max_id and doc_id in self._rows_by_id():
+            raise ValueError('Document id %i is already in the index' % doc_id)
+
+        self.hashes.append(_hash)
+        self.ids.append(doc_id)
+        self._max_id = max(doc_id, self._max_id)
+
+        if self._id_rows is not None:
+            self._id_rows[doc_id] = row
+
+        if not self.compact:
+            self.simhashes.append(simhash)
+
+        return row, _hash
+
+    def _check_hashbits(self, hashes):
+        if hashes.hashbits != self.hashbits:
+            raise ValueError('Hashes must be of equal size to be indexed')
+
+    def _extend_packed(self, hash_array, doc_ids):
+        """Copy the packed hashes of a `HashArray` to the columns (compact
+        indexes need no Simhash objects)
+        """
+        start = len(self.hashes)
+        end = start + len(hash_array)
+
+        if doc_ids is None:
+            doc_ids = range(start + self.purged, end + self.purged)
+
+        doc_ids = array('q', doc_ids)
+
+        if len(doc_ids) != end - start:
+            raise ValueError('Expected %i document ids' % (end - start))
+        elif not doc_ids:
+            return
+
+        # Increasing ids (e.g., the default ones) are unique
+        unique = all(x < y for x, y in pairwise(doc_ids)) or len(
+            set(doc_ids)) == len(doc_ids)
+
+        if not unique or min(doc_ids) <= self._max_id and not (
+                self._rows_by_id().keys().isdisjoint(doc_ids)):
+            raise ValueError('Document ids must be unique')
+
+        self.hashes.extend(hash_array.hashes)
+        self.ids.extend(doc_ids)
+        self._max_id = max(max(doc_ids), self._max_id)
+
+        if self._id_rows is not None:
+            self._id_rows.update(zip(doc_ids, range(start, end)))
+
+    def _append_many(self, simhashes, doc_ids):
+        """Append a row for each Simhash object (or hash value) and its
+        document id. Nothing is appended if there are more or fewer ids, if
+        an id is already in the index, or if anything else fails.
+        """
+        start, missing = len(self.hashes), object()
+
+        if doc_ids is None:
+            pairs = zip(simhashes, it.repeat(None))
+        else:
+            pairs = it.zip_longest(simhashes, doc_ids, fillvalue=missing)
+
+        try:
+            for simhash, doc_id in pairs:
+                if simhash is missing or doc_id is missing:
+                    raise ValueError('Each simhash must have one document id')
+
+                self._append(simhash, doc_id)
+        except BaseException:
+            self._truncate(start)
+            raise
+
+    def _truncate(self, length):
+        "Drop the (unbucketed) rows from 'length' onwards"
+        del self.hashes[length:]
+        del self.ids[length:]
+
+        if not self.compact:
+            del self.simhashes[length:]
+
+        self._id_rows = None
+
+    def _bucket_row(self, row, _hash):
+        for key in self.get_keys(_hash):
+            self.bucket.setdefault(key, array('Q')).append(row)
+
+    def extend(self, simhashes, doc_ids=None):
+        """Add many Simhash objects (or hash values) to the index. 'doc_ids'
+        is an iterable of their (integer) document ids and defaults to the
+        ids of a `HashArray` (if any), or else the row numbers. Raises a
+        ValueError (and adds nothing) if the numbers of simhashes and ids
+        differ, if an id is repeated or already in the index, or if the
+        hashes are of a different size. With numpy, the new rows' bucket
+        keys are computed and sorted in one pass, and each bucket is
+        extended once.
+        """
+        if self.tables is not None:
+            self.purge()
+
+        start = len(self.hashes)
+
+        if isinstance(simhashes, HashArray):
+            self._check_hashbits(simhashes)
+            doc_ids = simhashes.ids if doc_ids is None else doc_ids
+
+        if self.compact and isinstance(simhashes, HashArray) and type(
+                self.hashes) == type(simhashes.hashes) == array:
+            self._extend_packed(simhashes, doc_ids)
+        else:
+            self._append_many(simhashes, doc_ids)
+
+        if np is None or type(self.hashes) == list:
+            for row in range(start, len(self.hashes)):
+                self._bucket_row(row, self.hashes[row])
+        elif len(self.hashes) > start:
+            self._bucket_rows(start)
+
+    def _bucket_rows(self, start):
+        "Add the packed rows from 'start' onwards to the buckets (with numpy)"
+        hashes = np.frombuffer(self.hashes, dtype=np.uint64)[start:]
+        rows = np.arange(start, start + len(hashes), dtype=np.uint64)
+        keys = self._key_array(hashes)
+
+        # A stable sort keeps each bucket's rows in order
+        order = np.argsort(keys, kind='stable')
+        keys = keys[order]
+        rows = np.tile(rows, len(keys) // len(rows))[order]
+        bounds = np.flatnonzero(keys[1:] != keys[:-1]) + 1
+        bounds = [0] + bounds.tolist() + [len(keys)]
+
+        for lo, hi in pairwise(bounds):
+            bucket = self.bucket.setdefault(int(keys[lo]), array('Q'))
+            bucket.frombytes(rows[lo:hi].tobytes())
+
+    def _rows_by_id(self):
+        """A map of document ids to (live) rows. It's only built when needed
+        (to remove a document or check an id that may already exist) since
+        it takes more memory than the packed columns.
+        """
+        if self._id_rows is None:
+            self._id_rows = {
+                doc_id: row for row, doc_id in enumerate(self.ids)
+                if row not in self.removed}
+
+        return self._id_rows
+
+    def remove(self, simhash_or_id):
+        """Remove a document by its (integer) id, or all documents with the
+        hash of a Simhash object. Raises KeyError if there are none.
+        """
+        if hasattr(simhash_or_id, 'hash'):
+            _hash = simhash_or_id.hash
+            rows = {
+                row for row in self._candidates(_hash)
+                if self.hashes[row] == _hash and row not in self.removed}
+        else:
+            row = self._rows_by_id().get(simhash_or_id)
+            rows = set() if row is None else {row}
+
+        if not rows:
+            raise KeyError(simhash_or_id)
+
+        self.removed.update(rows)
+
+        if self._id_rows is not None:
+            for row in rows:
+                if self._id_rows.get(self.ids[row]) == row:
+                    del self._id_rows[self.ids[row]]
+
+        ratio = self.purge_ratio
+
+        if ratio is not None and len(self.removed) > ratio * len(self.hashes):
+            self.purge()
+
+    def update(self, doc_id, simhash):
+        "Replace the Simhash object (or hash value) of a document"
+        self.remove(doc_id)
+        self.add(simhash, doc_id)
+
+    def purge(self):
+        """Drop the removed rows (renumbering the others) and rebuild the
+        buckets. A loaded index is also copied into memory.
+        """
+        live = [
+            row for row in range(len(self.hashes)) if row not in self.removed]
+
+        if self.compact:
+            entries = [self.hashes[row] for row in live]
+        else:
+            entries = [self.simhashes[row] for row in live]
+
+        ids = [self.ids[row] for row in live]
+        purged = self.purged + len(self.hashes) - len(live)
+        self.close()
+        self._reset()
+        self.purged = purged
+        self.extend(entries, ids)
+
+    def _candidate_runs(self, _hash):
+        "Yields the buckets (packed sequences of rows) of a hash's keys"
+        bucket = self.bucket
+
+        for key in self.get_keys(_hash):
+            if key in bucket:
+                yield bucket[key]
+
+    def _candidates(self, _hash):
+        "Yields the rows that share (at least) one block with a hash"
+        for run in self._candidate_runs(_hash):
+            for row in run:
+                yield row
+
+    def _dupe_rows(self, _hash):
+        "The rows within `bits` of a hash, closest first"
+        seen = set()
+        hashes = self.hashes
+        dupes = []
+
+        for row in self._candidates(_hash):
+            if row not in seen and row not in self.removed:
+                seen.add(row)
+                distance = popcount(_hash ^ hashes[row])
+
+                if distance <= self.bits:
+                    dupes.append((distance, row))
+
+        return [row for _, row in sorted(dupes)]
+
+    def _dupe_rows_many(self, hashes):
+        """The rows within `bits` of each hash, closest first. With numpy,
+        the candidates of each batch of hashes are filtered at once.
+        """
+        if np is None or type(self.hashes) == list:
+            return [self._dupe_rows(_hash) for _hash in hashes]
+
+        columns = np.frombuffer(self.hashes, dtype=np.uint64)
+        removed = np.fromiter(self.removed, np.uint64, len(self.removed))
+        results = []
+
+        for chunk in chunked(hashes, DOC_BATCH_SIZE):
+            values = np.array(chunk, dtype=np.uint64)
+            rows, sizes = array('Q'), []
+
+            for _hash in chunk:
+                size = len(rows)
+                [rows.extend(run) for run in self._candidate_runs(_hash)]
+                sizes.append(len(rows) - size)
+
+            rows = np.frombuffer(rows, dtype=np.uint64)
+            queries = np.repeat(np.arange(len(chunk)), sizes)
+            distances = popcount_array(columns[rows] ^ values[queries])
+            keep = distances <= self.bits
+
+            if len(removed):
+                keep &= ~np.isin(rows, removed)
+
+            queries, distances = queries[keep], distances[keep]
+            rows = rows[keep]
+
+            # Sort by query, distance, and then row, and drop repeated rows
+            order = np.lexsort((rows, distances, queries))
+            queries, rows = queries[order], rows[order]
+            unique = np.ones(len(rows), dtype=bool)
+            unique[1:] = rows[1:] != rows[:-1]
+            unique[1:] |= queries[1:] != queries[:-1]
+            queries, rows = queries[unique], rows[unique]
+            bounds = np.searchsorted(queries, np.arange(len(chunk) + 1))
+            rows = rows.tolist()
+            results.extend(rows[lo:hi] for lo, hi in pairwise(bounds))
+
+        return results
+
+    def find_dupes_many(self, simhashes):
+        """Find the duplicates of many Simhash objects (or hash values) at
+        once. Returns a list of lists of duplicates (as in `find_dupes`).
+        """
+        hashes = [getattr(simhash, 'hash', simhash) for simhash in simhashes]
+
+        return [
+            [self._entry(row) for row in rows]
+            for rows in self._dupe_rows_many(hashes)]
+
+    def find_dupe_ids_many(self, simhashes):
+        """Find the document ids of the duplicates of many Simhash objects
+        (or hash values) at once. Returns a list of lists of ids.
+        """
+        hashes = [getattr(simhash, 'hash', simhash) for simhash in simhashes]
+        ids = self.ids
+
+        return [
+            [ids[row] for row in rows]
+            for rows in self._dupe_rows_many(hashes)]
+
+    def find_dupes(self, simhash):
+        """Yields the indexed Simhash objects that are duplicates of
+        'simhash', closest (by hamming distance) first.
+        """
+        for row in self._dupe_rows(getattr(simhash, 'hash', simhash)):
+            yield self._entry(row)
+
+    def find_dupe_ids(self, simhash):
+        "Yields the document ids of the duplicates of 'simhash'"
+        for row in self._dupe_rows(getattr(simhash, 'hash', simhash)):
+            yield self.ids[row]
+
+    def _scan_rows(self, _hash, k):
+        "The 'k' closest (live) rows to a hash, found by scanning every row"
+        distances = hamming_many(_hash, self.hashes)
+
+        if type(distances) == list:
+            pairs = (
+                (distance, row) for row, distance in enumerate(distances)
+                if row not in self.removed)
+
+            return [row for _, row in nsmallest(k, pairs)]
+
+        rows = np.lexsort((np.arange(len(distances)), distances)).tolist()
+        return [row for row in rows if row not in self.removed][:k]
+
+    def _nearest_rows(self, _hash, k):
+        """The 'k' closest rows to a hash, closest first. Indexes without a
+        multi-index search (see `SimhashIndex`) scan every row.
+        """
+        return self._scan_rows(_hash, k)
+
+    def nearest(self, simhash, k=10):
+        """The (at most) 'k' indexed Simhash objects closest (by hamming
+        distance) to 'simhash', closest first
+        """
+        rows = self._nearest_rows(getattr(simhash, 'hash', simhash), k)
+        return [self._entry(row) for row in rows]
+
+    def nearest_ids(self, simhash, k=10):
+        "The document ids of the 'k' Simhash objects closest to 'simhash'"
+        rows = self._nearest_rows(getattr(simhash, 'hash', simhash), k)
+        return [self.ids[row] for row in rows]
+
+    def _dupe_pairs(self, workers=None):
+        """Yields each (row, row) pair of duplicates exactly once by finding
+        the duplicates of every row's hash (in batches)
+        """
+        for start in range(0, len(self.hashes), DOC_BATCH_SIZE):
+            hashes = self.hashes[start:start + DOC_BATCH_SIZE]
+            rows = self._dupe_rows_many(hashes)
+
+            for row, others in enumerate(rows, start):
+                for other in others:
+                    if other > row:
+                        yield row, other
+
+    def _sorted_pairs(self, workers=None):
+        hashes, removed = self.hashes, self.removed
+
+        for row, other in self._dupe_pairs(workers):
+            if removed and (row in removed or other in removed):
+                continue
+
+            if hashes[other] < hashes[row]:
+                row, other = other, row
+
+            yield row, other
+
+    # https://github.com/seomoz/simhash-cpp/blob/master/src/simhash.cpp
+    def find_all_dupes(self, workers=None):
+        """Yields each pair of duplicate Simhash objects (sorted by hash)
+        exactly once. If 'workers' is greater than 1, a `SimhashIndex` scans
+        its tables in a pool of that many processes (and pairs arrive in no
+        set order). The pool needs shared memory (Python 3.8+), so older
+        Pythons scan the tables one by one. Other indexes ignore 'workers'.
+        """
+        for row, other in self._sorted_pairs(workers):
+            yield (self._entry(row), self._entry(other))
+
+    def find_all_dupe_ids(self, workers=None):
+        """Yields the document ids of each pair of duplicates (sorted by
+        hash) exactly once. See `find_all_dupes` for 'workers'.
+        """
+        for row, other in self._sorted_pairs(workers):
+            yield (self.ids[row], self.ids[other])
+
+    def clusters(self, workers=None, key=None):
+        """Group the documents into clusters of (transitive) duplicates with
+        union-find, as the pairs of duplicates are generated (so the pairs
+        are never held in memory). See `find_all_dupes` for 'workers'.
+
+        Returns (labels, sizes). 'labels' is an array of the document id of
+        each row's cluster representative (parallel to `ids`, and -1 for
+        removed rows). 'sizes' maps the representative of each cluster with
+        more than one document to its size. The representative is the first
+        document added, or if 'key' is given, the document whose id has the
+        smallest `key(id)`.
+        """
+        num_rows = len(self.hashes)
+        parent = array('q', range(num_rows))
+
+        def find(row):
+            # Path halving
+            while parent[row] != row:
+                parent[row] = parent[parent[row]]
+                row = parent[row]
+
+            return row
+
+        # The root of each cluster is its first row
+        for row, other in self._sorted_pairs(workers):
+            root, other_root = find(row), find(other)
+
+            if root < other_root:
+                parent[other_root] = root
+            elif other_root < root:
+                parent[root] = other_root
+
+        ids, removed = self.ids, self.removed
+        counts = array('q', bytes(8 * num_rows))
+        roots = array('q', map(find, range(num_rows)))
+
+        for row, root in enumerate(roots):
+            counts[root] += row not in removed
+
+        # Each cluster's root is its own root, and its initial representative
+        representatives = {
+            row: row for row, root in enumerate(roots)
+            if row == root and counts[row] > 1}
+
+        if key is not None:
+            for row, root in enumerate(roots):
+                best = representatives.get(root)
+
+                if best is not None and key(ids[row]) < key(ids[best]):
+                    representatives[root] = row
+
+        labels = array('q', (
+            -1 if row in removed else ids[representatives.get(root, root)]
+            for row, root in enumerate(roots)))
+
+        sizes = {
+            ids[representatives[root]]: counts[root]
+            for root in representatives}
+
+        return labels, sizes
+
+    def close(self):
+        "Release the data of an index created by `load`"
+        mapped, view = getattr(self, '_mapped', (None, None))
+
+        if view is not None:
+            [table.release() for table in self.tables]
+            self.hashes.release()
+            self.ids.release()
+            view.release()
+
+            if mapped is not None:
+                mapped.close()
+
+            self.hashes = self.ids = self.tables = None
+            self._mapped = (None, None)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class SimhashIndex(BaseIndex):
+    def __init__(
+            self, simhashes, bits=2, num_blocks=6, compact=False,
+            hashbits=None, purge_ratio=None):
+        """
+        'simhashes' is a list of Simhash objects (or hash values) or a
+        `HashArray`, 'bits' is the maximum number of bits in which
+        duplicates may differ, and 'num_blocks' is the number of blocks
+        each hash is split into.
+
+        The index stores the hashes and document ids in packed arrays and
+        its buckets map integer (block, value) keys to packed arrays of row
+        numbers. Unless 'compact' is True, it also keeps the original
+        Simhash objects so `find_dupes` can return them. Compact indexes
+        return new Simhash objects instead (use `find_dupe_ids` to get the
+        document ids). 'hashbits' defaults to that of the first simhash
+        (or the `HashArray`).
+
+        Removed documents are skipped until `purge` drops them. If
+        'purge_ratio' is set, `remove` purges whenever the removed
+        fraction of rows exceeds it.
+        """
+        super(SimhashIndex, self).__init__(
+            simhashes, hashbits, purge_ratio, bits, num_blocks, compact)
+
+    def _configure(self, hashbits, bits, num_blocks, compact):
+        self.hashbits = hashbits
         self.bits = bits
         self.num_blocks = num_blocks or bits + 1
+        self.compact = compact
+        self.purge_ratio = None
+        self.purged = 0
+        self.tables = None
         max_blocks = self.hashbits // 2
 
         if self.num_blocks > max_blocks:
             raise ValueError('Number of blocks must not exceed %i' % max_blocks)
 
         self.block_range = range(self.num_blocks)
-        self.bucket = defaultdict(set)
-        [self.add(simhash) for simhash in simhashes]
 
-    def add(self, simhash):
-        assert simhash.hashbits == self.hashbits
+        # http://www.wwwconference.org/www2007/papers/paper215.pdf
+        self.offsets = [
+            self.hashbits // self.num_blocks * i for i in self.block_range]
 
-        for key in self.get_keys(simhash):
-            self.bucket[key].add(simhash)
+        self.offsets.append(self.hashbits)
+        self.widths = [j - i for i, j in pairwise(self.offsets)]
+        self.bit_widths = [2 ** width - 1 for width in self.widths]
+        self.blocks = [
+            bit_width << offset
+            for offset, bit_width in zip(self.offsets, self.bit_widths)]
 
-    @property
-    def offsets(self):
-        # http://www.wwwconference.org/www2007/papers/paper215.pdf
-        first = [self.hashbits // self.num_blocks * i for i in self.block_range]
-        return first + [self.hashbits]
+    @classmethod
+    def tuned(
+            cls, simhashes, bits=2, target='latency',
+            sample_size=DEF_SAMPLE_SIZE, seed=0, **kwargs):
+        """Create an index with the number of blocks that minimizes the
+        estimated query cost (if 'target' is 'latency'), memory (if
+        'target' is 'memory'), or `find_all_dupes` cost (if 'target' is
+        'all_pairs') of a list of Simhash objects (or hash values).
+
+        Each bucket key is a single block, so the fewest (and widest)
+        blocks always have the fewest candidates per query. But
+        `find_all_dupes` scans a table per combination of `bits` blocks, so
+        for it, more blocks trade more tables for fewer pairs per run.
+
+        The estimates come from a (seeded) sample of (at most) 'sample_size'
+        of the hashes, and are kept in the `estimates` attribute (one dict
+        per feasible number of blocks) so they can be checked against
+        measured costs. 'kwargs' are passed to the constructor.
+        """
+        costs = {'latency': 'cost', 'memory': 'bytes', 'all_pairs': 'scan'}
+
+        if target not in costs:
+            raise ValueError('Target must be latency, memory, or all_pairs')
+
+        hashbits = kwargs.pop('hashbits', None) or getattr(
+            simhashes, 'hashbits', None) or simhashes[0].hashbits
+        size, random = len(simhashes), Random(seed)
+        rows = random.sample(range(size), min(size, sample_size))
+        sample = [
+            getattr(simhashes[row], 'hash', simhashes[row]) for row in rows]
+        block_range = range(bits + 1, hashbits // 2 + 1)
+
+        estimates = [
+            cls._estimate(sample, size, bits, num_blocks, hashbits, random)
+            for num_blocks in block_range]
+
+        if not estimates:
+            raise ValueError('Bits must be less than %i' % (hashbits // 2))
+
+        best = min(estimates, key=itemgetter(costs[target]))
+        index = cls(
+            simhashes, bits, best['num_blocks'], hashbits=hashbits, **kwargs)
+
+        index.estimates = estimates
+        return index
+
+    @staticmethod
+    def _estimate(sample, size, bits, num_blocks, hashbits, random):
+        """Estimate the costs of indexing 'size' hashes in 'num_blocks'
+        blocks from a sample of them (and a random sample of the tables):
+
+        candidates: the mean (non-distinct) number of candidates per query,
+            i.e., 'size' times the sample's chance that two hashes share a
+            block (summed over the blocks)
+        buckets: the expected number of buckets (assuming uniformly
+            distributed block values)
+        bytes: the approximate memory used by the buckets
+        cost: the relative cost of a query (a bucket lookup per block plus
+            a distance check per candidate)
+        tables: the number of tables `find_all_dupes` scans
+        pairs: the mean number of pairs of rows in the runs (of equal kept
+            blocks) of a table, i.e., the pairs of 'size' hashes times the
+            sample's chance that two hashes share the kept blocks
+        scan: the relative cost of `find_all_dupes` (a pass over the rows
+            plus a distance check per run pair, for each table)
+        """
+        index = SimhashIndex(
+            [], bits, num_blocks, compact=True, hashbits=hashbits)
 
-    @property
-    def widths(self):
-        return [j - i for i, j in pairwise(self.offsets)]
+        counts = Counter(it.chain.from_iterable(map(index.get_keys, sample)))
+        num_pairs = len(sample) * (len(sample) - 1)
+        shared = sum(count * (count - 1) for count in counts.values())
+        candidates = size * shared / num_pairs if num_pairs else 0
 
-    @property
-    def bit_widths(self):
-        return [2 ** width - 1 for width in self.widths]
+        buckets = sum(
+            2 ** width * (1 - (1 - 2 ** -width) ** size)
+            for width in index.widths)
 
-    @property
-    def blocks(self):
-        # https://github.com/seomoz/simhash-cpp/blob/master/src/permutation.cpp#L82
-        for i in self.block_range:
-            start = (i * self.hashbits) // self.num_blocks
-            end = ((i + 1) * self.hashbits) // self.num_blocks
-            yield reduce(lambda x, y: x | (1 << y), range(start, end), 0)
+        # Only a sample of the tables are counted if there are many (there
+        # can be millions)
+        tables = comb(num_blocks, bits)
+
+        if tables <= SAMPLE_TABLES:
+            masks = [mask for _, mask in index._tables()]
+        else:
+            block_range, kept = range(num_blocks), set()
+
+            while len(kept) < SAMPLE_TABLES:
+                blocks = random.sample(block_range, num_blocks - bits)
+                kept.add(tuple(sorted(blocks)))
+
+            masks = [
+                reduce(or_, (index.blocks[i] for i in blocks), 0)
+                for blocks in sorted(kept)]
+
+        shared = 0
+
+        for mask in masks:
+            counts = Counter(_hash & mask for _hash in sample)
+            shared += sum(count * (count - 1) for count in counts.values())
+
+        shared /= len(masks)
+        pairs = size * (size - 1) * shared / num_pairs / 2 if num_pairs else 0
+
+        return {
+            'num_blocks': num_blocks,
+            'candidates': candidates,
+            'buckets': buckets,
+            'bytes': 8 * num_blocks * size + BUCKET_BYTES * buckets,
+            'cost': num_blocks + candidates,
+            'tables': tables,
+            'pairs': pairs,
+            'scan': tables * (size + pairs)}
+
+    def _key_array(self, hashes):
+        """The bucket keys of a numpy uint64 array of hashes (all of the
+        first block's keys, then the second's, ...)
+        """
+        num_blocks = np.uint64(self.num_blocks)
+        pairs = zip(self.offsets, self.bit_widths)
+
+        return np.concatenate([
+            (hashes >> np.uint64(offset) & np.uint64(bit_width)) *
+            num_blocks + np.uint64(i) for i, (offset, bit_width) in
+            enumerate(pairs)])
 
     def get_keys(self, simhash):
-        for i, pair in enumerate(zip(self.offsets, self.bit_widths)):
-            offset, bit_width = pair
-            key = simhash.hash >> offset & bit_width
-            yield '%x:%x' % (key, i)
+        "The bucket keys of a Simhash object (or hash value)"
+        _hash = getattr(simhash, 'hash', simhash)
+        pairs = zip(self.offsets, self.bit_widths)
 
-    def find_dupes(self, simhash):
-        seen = set()
+        for i, (offset, bit_width) in enumerate(pairs):
+            yield (_hash >> offset & bit_width) * self.num_blocks + i
 
-        for key in self.get_keys(simhash):
-            for entry in self.bucket[key]:
-                entry_id = id(entry)
-                not_seen = entry_id not in seen
+    def _candidate_runs(self, _hash):
+        """Yields the (packed) sequences of rows that share a block with a
+        hash: its buckets, or the matching runs of a loaded index's tables
+        """
+        if self.tables is None:
+            for run in super(SimhashIndex, self)._candidate_runs(_hash):
+                yield run
+        else:
+            hashes = self.hashes
+            pairs = zip(self.tables, self.offsets, self.bit_widths)
 
-                if not_seen and simhash.hamming_distance(entry) <= self.bits:
-                    seen.add(entry_id)
-                    yield entry
+            for table, offset, bit_width in pairs:
+                value = _hash >> offset & bit_width
+                key = lambda row: hashes[row] >> offset & bit_width
+                yield _search(table, key, value)
 
-    # https://github.com/seomoz/simhash-cpp/blob/master/src/simhash.cpp
-    def find_all_dupes(self):
-        blocks = list(self.blocks)
-        widths = self.widths
-        seen = set()
+    def _block_rows(self, block, value):
+        "The rows whose 'block' has 'value'"
+        if self.tables is None:
+            return self.bucket.get(value * self.num_blocks + block, ())
+
+        hashes = self.hashes
+        offset, bit_width = self.offsets[block], self.bit_widths[block]
+        key = lambda row: hashes[row] >> offset & bit_width
+        return _search(self.tables[block], key, value)
+
+    def _nearest_rows(self, _hash, k):
+        """The 'k' closest rows to a hash, closest first. Each round flips
+        one more bit of every block value and looks up the matching rows.
+        By the pigeonhole principle, once all blocks have been probed with
+        `flips` flipped bits, every hash within `num_blocks * (flips + 1)
+        - 1` bits has been found.
+
+        This replaces a BK-tree (so there is no second structure to keep up
+        to date). The rows are only scanned instead if the search can't
+        stop early, i.e., if 'k' covers every (live) row, or once a round
+        would probe more values than there are rows.
+        """
+        if k >= len(self):
+            return self._scan_rows(_hash, k)
+
+        hashes, removed, found = self.hashes, self.removed, {}
+        pairs = zip(self.offsets, self.bit_widths)
+        values = [_hash >> offset & bit_width for offset, bit_width in pairs]
+
+        for flips in range(max(self.widths) + 1):
+            if sum(comb(width, flips) for width in self.widths) > len(hashes):
+                return self._scan_rows(_hash, k)
+
+            for block, width in enumerate(self.widths):
+                for positions in it.combinations(range(width), flips):
+                    masks = (1 << position for position in positions)
+                    value = reduce(xor, masks, values[block])
+
+                    for row in self._block_rows(block, value):
+                        if row not in found and row not in removed:
+                            found[row] = popcount(_hash ^ hashes[row])
+
+            radius = self.num_blocks * (flips + 1) - 1
+            nearest = sorted(
+                (distance, row) for row, distance in found.items()
+                if distance <= radius)
+
+            if len(nearest) >= k:
+                break
+        else:
+            pairs = found.items()
+            nearest = sorted((distance, row) for row, distance in pairs)
+
+        return [row for _, row in nearest[:k]]
+
+    def _tables(self):
+        """Yields the kept blocks and mask of each table. By the pigeonhole
+        principle, duplicates must match in (at least) `num_blocks - bits`
+        blocks, so there is one table per combination of those blocks.
+        """
+        if self.num_blocks <= self.bits:
+            raise ValueError('Number of blocks must exceed bits')
+
+        num_kept = self.num_blocks - self.bits
+
+        for kept in it.combinations(self.block_range, num_kept):
+            yield kept, reduce(or_, (self.blocks[i] for i in kept), 0)
+
+    def _dupe_pairs(self, workers=None):
+        "Yields each (row, row) pair of duplicates exactly once"
+        # Workers read wide hashes as numpy arrays
+        parallel = SharedMemory is not None and (
+            self.hashbits <= 64 or np is not None)
+
+        if workers and workers > 1 and parallel:
+            pairs = self._parallel_dupe_pairs(workers)
+        else:
+            pairs = (
+                pair for kept, mask in self._tables()
+                for pair in _table_dupes(
+                    self.hashes, mask, kept, self.blocks, self.bits))
+
+        for pair in pairs:
+            yield pair
+
+    def _parallel_dupe_pairs(self, workers):
+        """Scan the tables in a pool of 'workers' processes, which read the
+        hashes from shared memory (rather than each receiving a copy). Each
+        task sorts and walks one table, and at most two tables per worker
+        are in flight, so only their pairs are held in memory at once.
+        """
+        length = len(self.hashes)
+
+        if self.hashbits <= 64:
+            width, data = 8, self.hashes.tobytes()
+        else:
+            width = -(-self.hashbits // 8)
+            data = b''.join(h.to_bytes(width, 'little') for h in self.hashes)
+
+        shm = SharedMemory(create=True, size=max(len(data), 1))
+
+        try:
+            shm.buf[:len(data)] = data
+            del data
+
+            with ProcessPoolExecutor(workers) as executor:
+                pending = set()
+
+                # Each pair is only found in one table, so the streams can
+                # simply be merged as they complete
+                for kept, mask in self._tables():
+                    # Limit the number of tables held in memory at once
+                    if len(pending) >= 2 * workers:
+                        done, pending = wait(
+                            pending, return_when=FIRST_COMPLETED)
+
+                        for pair in _completed_pairs(done):
+                            yield pair
+
+                    pending.add(executor.submit(
+                        _shared_table_dupes, shm.name, length, width, mask,
+                        kept, self.blocks, self.bits))
+
+                for pair in _completed_pairs(as_completed(pending)):
+                    yield pair
+        finally:
+            shm.close()
+            shm.unlink()
+
+    def _sorted_tables(self):
+        """The rows of each block's table, sorted by the block's value (and
+        then row)
+        """
+        if self.tables is not None:
+            return self.tables
+
+        tables = [array('Q') for _ in self.block_range]
+
+        # Keys sort by value and then block
+        for key in sorted(self.bucket):
+            tables[key % self.num_blocks].extend(self.bucket[key])
+
+        return tables
+
+    def save(self, path):
+        """Write the index to a file: a header, the hashes, the document ids,
+        and then a table of rows (sorted by value) for each block. The
+        arrays are stored in native byte order. Simhash objects aren't
+        saved, so the loaded index is compact. Removed rows are purged
+        first.
+        """
+        if self.hashbits > 64:
+            raise ValueError('Only indexes of hashes <= 64 bits can be saved')
+        elif self.removed:
+            self.purge()
+
+        header = _HEADER.pack(
+            MAGIC, VERSION, self.hashbits, self.bits, self.num_blocks,
+            len(self), self.purged)
+
+        with open(path, 'wb') as f:
+            f.write(header)
+            f.write(self.hashes)
+            f.write(self.ids)
+            [f.write(table) for table in self._sorted_tables()]
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        """Load an index saved with `save`. Queries binary search the sorted
+        tables, so nothing is rebuilt. If 'mmap' is True, the file is memory
+        mapped (and shared with the OS page cache, and therefore any other
+        process that loads the same file) instead of being read into memory.
+
+        Adding to a loaded index first copies it into memory. Call `close`
+        (or use a `with` block) when done.
+        """
+        with open(path, 'rb') as f:
+            if mmap:
+                mapped = memory_map(f.fileno(), 0, access=ACCESS_READ)
+            else:
+                mapped = f.read()
+
+        view = memoryview(mapped)
+
+        try:
+            index = cls._from_buffer(view)
+        except ValueError:
+            view.release()
+
+            if mmap:
+                mapped.close()
+
+            raise
+
+        index._mapped = (mapped if mmap else None, view)
+        return index
+
+    @classmethod
+    def _from_buffer(cls, buf):
+        "Create a (compact) index from the output of `save` without copying"
+        if len(buf) < _HEADER.size:
+            raise ValueError('Not enough data for a Simhash index header')
+
+        header = _HEADER.unpack_from(buf)
+        magic, version, hashbits, bits, num_blocks, length, purged = header
+
+        if magic != MAGIC or version != VERSION:
+            raise ValueError('Not a (supported) Simhash index file')
+
+        index = cls.__new__(cls)
+        index._configure(hashbits, bits, num_blocks, True)
+        index.purged = purged
+        size = 8 * length
+        end = _HEADER.size + (num_blocks + 2) * size
+
+        if len(buf) < end:
+            raise ValueError('Simhash index data is truncated')
+
+        starts = [_HEADER.size + i * size for i in range(num_blocks + 2)]
+        columns = [buf[start:start + size] for start in starts]
+
+        index.hashes = columns[0].cast('Q')
+        index.ids = columns[1].cast('q')
+        index.tables = [column.cast('Q') for column in columns[2:]]
+        index.simhashes = index.bucket = index._id_rows = None
+        index._max_id = max(index.ids, default=float('-inf'))
+        index.removed = set()
+        [column.release() for column in columns]
+        return index
+
+
+def dedupe_stream(
+        documents, key=None, bits=3, num_blocks=6, hashbits=DEF_HASHBITS,
+        max_size=None, max_age=None, timestamp=None, annotate=False):
+    """Yields the documents of a (possibly unbounded) iterable that aren't
+    duplicates (within 'bits') of an earlier one, in one pass. 'key' maps a
+    document to the string (or tokens) to hash and defaults to the document
+    itself. If 'annotate' is True, yields a (document, dupe ids) pair for
+    every document instead, where the dupe ids are the positions (in
+    'documents') of the earlier (novel) documents it duplicates.
+
+    Only the hashes of novel documents are indexed. To bound memory, the
+    oldest are evicted once there are more than 'max_size', or once they are
+    more than 'max_age' older than the current document. 'timestamp' maps a
+    document to its time and defaults to its arrival (`time.monotonic`).
+    """
+    index = SimhashIndex(
+        [], bits, num_blocks, compact=True, hashbits=hashbits,
+        purge_ratio=0.5)
+
+    kept = deque()
+
+    for position, document in enumerate(documents):
+        now = monotonic() if timestamp is None else timestamp(document)
+
+        while max_age is not None and kept and now - kept[0][1] > max_age:
+            index.remove(kept.popleft()[0])
+
+        data = document if key is None else key(document)
+        _hash = Simhash(data, hashbits).hash
+        dupes = list(index.find_dupe_ids(_hash))
+
+        if not dupes:
+            index.add(_hash, doc_id=position)
+            kept.append((position, now))
+
+            if max_size is not None and len(kept) > max_size:
+                index.remove(kept.popleft()[0])
 
-        for permutation in it.permutations(self.block_range, self.bits):
-            extra = set(permutation).symmetric_difference(self.block_range)
-            order = permutation + tuple(extra)
-            masks = [blocks[i] for i in order]
-            new_widths = [widths[i] for i in order]
-            permuter = Permuter(
-                self.bits, masks, new_widths, hashbits=self.hashbits)
-
-            for simhash in self.simhashes:
-                simhash.permhash = permuter.permute(simhash.hash)
-
-            permuted = sorted(self.simhashes, key=attrgetter('permhash'))
-            mask = permuter.search_mask
-            start = permuted[0]
-            end_func = lambda x: (x.permhash & mask) == (start.permhash & mask)
-
-            for i, simhash in enumerate(it.takewhile(end_func, permuted)):
-                id1 = id(simhash)
-
-                for other in it.takewhile(end_func, permuted[i + 1:]):
-                    entry_ids = frozenset([id1, id(other)])
-                    not_seen = entry_ids not in seen
-
-                    if not_seen and simhash.hamming_distance(other) <= self.bits:
-                        pair = [simhash, other]
-                        seen.add(entry_ids)
-                        yield tuple(sorted(pair, key=attrgetter('hash')))
+        if annotate:
+            yield document, dupes
+        elif not dupes:
+            yield document
@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+# vim: sw=4:ts=4:expandtab
+
+"""
+Benchmarks comparing changanya's data structure variants.
+
+usage::
+    python -m examples.benchmarks [capacity] [false_positive_rate]
+"""
+import sys
+import random
+
+from timeit import default_timer as timer
+
+from changanya.bloom import Bloomfilter, BlockedBloomfilter
+from changanya.hashtype import popcount
+from changanya.lsh import LSHIndex
+
+# (num_tables, sample_bits, probe_bits)
+LSH_CONFIGS = [(8, 12, 0), (8, 16, 1), (16, 16, 1), (32, 20, 1)]
+
+
+def _rate(count, start):
+    return count / (timer() - start)
+
+
+def bloom_lookups(capacity=10 ** 5, false_positive_rate=0.0001, lookups=None):
+    """Compare the lookup throughput and measured false positive rate of the
+    standard and blocked Bloom filter layouts (filled to capacity).
+    """
+    lookups = lookups or capacity
+    present = ['present-%i' % i for i in range(capacity)]
+    absent = ['absent-%i' % i for i in range(lookups)]
+    results = []
+
+    for cls in [Bloomfilter, BlockedBloomfilter]:
+        bloomfilter = cls(
+            capacity=capacity, false_positive_rate=false_positive_rate)
+
+        bloomfilter.add_many(present)
+        start = timer()
+        found = sum(item in bloomfilter for item in absent)
+        single_rate = _rate(lookups, start)
+        start = timer()
+        bloomfilter.contains_many(absent)
+        batch_rate = _rate(lookups, start)
+
+        results.append({
+            'name': cls.__name__,
+            'hashbits': bloomfilter.hashbits,
+            'num_hashes': bloomfilter.num_hashes,
+            'in_per_sec': single_rate,
+            'batch_per_sec': batch_rate,
+            'false_positive_rate': found / lookups})
+
+    return results
+
+
+def lsh_recall(size=10 ** 4, bits=8, queries=500, configs=None, seed=0):
+    """Compare the recall (of all hashes within 'bits') and query throughput
+    of `LSHIndex` configurations against a brute force scan of 'size'
+    random 64 bit hashes. Each query is an indexed hash with up to 'bits'
+    (random) bits flipped.
+    """
+    rand = random.Random(seed)
+    hashes = [rand.getrandbits(64) for _ in range(size)]
+    targets = []
+
+    for _hash in rand.sample(hashes, queries):
+        for position in rand.sample(range(64), rand.randint(0, bits)):
+            _hash ^= 1 << position
+
+        targets.append(_hash)
+
+    start = timer()
+
+    expected = [
+        {row for row, h in enumerate(hashes) if popcount(h ^ q) <= bits}
+        for q in targets]
+
+    results = [{
+        'name': 'brute force', 'recall': 1.0, 'expected_recall': 1.0,
+        'queries_per_sec': _rate(queries, start)}]
+
+    for num_tables, sample_bits, probe_bits in configs or LSH_CONFIGS:
+        index = LSHIndex(
+            hashes, bits, num_tables, sample_bits, probe_bits, compact=True,
+            hashbits=64)
+
+        start = timer()
+        found = [set(index.find_dupe_ids(q)) for q in targets]
+        rate = _rate(queries, start)
+        hits = sum(len(f & e) for f, e in zip(found, expected))
+
+        results.append({
+            'name': 'lsh %i/%i/%i' % (num_tables, sample_bits, probe_bits),
+            'recall': hits / sum(map(len, expected)),
+            'expected_recall': index.recall(bits),
+            'queries_per_sec': rate})
+
+    return results
+
+
+def main(capacity=10 ** 5, false_positive_rate=0.0001):
+    row = '%-20s %10s %4s %14s %14s %10s'
+    print(row % ('layout', 'bits', 'k', 'in/sec', 'batch/sec', 'fpr'))
+
+    for result in bloom_lookups(int(capacity), float(false_positive_rate)):
+        print(row % (
+            result['name'], result['hashbits'], result['num_hashes'],
+            '%.0f' % result['in_per_sec'], '%.0f' % result['batch_per_sec'],
+            '%.6f' % result['false_positive_rate']))
+
+    print()
+    row = '%-20s %10s %16s %14s'
+    print(row % ('index', 'recall', 'min recall (est)', 'queries/sec'))
+
+    for result in lsh_recall():
+        print(row % (
+            result['name'], '%.4f' % result['recall'],
+            '%.4f' % result['expected_recall'],
+            '%.0f' % result['queries_per_sec']))
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:])
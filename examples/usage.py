@@ -49,6 +49,52 @@ basic usage::
     Traceback (most recent call last):
     ValueError: Hashes must be of equal size to find similarity
 
+    >>> # Hash many documents at once (vectorized with numpy when installed)
+    >>> from changanya.simhash import simhash_many
+    >>>
+    >>> many = simhash_many(['This is a test string one.', 'hello world'])
+    >>> many[0] == hash1, many[1] == Simhash('hello world')
+    (True, True)
+    >>> simhash_many([[('foo', 2), 'bar']])[0] == Simhash('foo foo bar')
+    True
+
+    >>> # Token hashes can be cached (shared by all Simhash objects)
+    >>> from changanya.simhash import (
+    ...     enable_token_cache, disable_token_cache, token_cache_info)
+    >>>
+    >>> enable_token_cache(maxsize=1024)
+    >>> Simhash('a b a b a') == Simhash('a b a b a', hashbits=64)
+    True
+    >>> token_cache_info()
+    CacheInfo(hits=8, misses=2, maxsize=1024, currsize=2)
+    >>> disable_token_cache()
+
+    >>> # Hash a stream piece by piece, optionally with weighted tokens
+    >>> streamed = Simhash()
+    >>> streamed.update('This is a test')
+    >>> streamed.update(['string', 'one.'])
+    >>> streamed.finalize() == hash1.hash
+    True
+    >>> Simhash([('foo', 2), 'bar']) == Simhash('foo foo bar')
+    True
+
+    >>> # Compare one (or many) hashes against many at once
+    >>> from changanya.hashtype import hamming_many, pairwise_hamming
+    >>>
+    >>> hamming_many(hash1, [hash1, hash2, 0])
+    [0, 7, 36]
+    >>> pairwise_hamming([hash1, hash2])
+    [[0, 7], [7, 0]]
+
+    >>> # Store many hashes (and their ids) compactly
+    >>> from changanya.hashtype import HashArray
+    >>>
+    >>> column = HashArray([hash1, hash2], ids=[10, 20])
+    >>> len(column), column[1] == hash2.hash, list(column.ids)
+    (2, True, [10, 20])
+    >>> [int(d) for d in hamming_many(hash1, column)]
+    [0, 7]
+
     >>> # Use the Simhash Index
     >>> from changanya.simhash import SimhashIndex
     >>>
@@ -75,21 +121,116 @@ basic usage::
     >>> dupe = next(index.find_dupes(simhash))
     >>> dupe == simhash
     True
-    >>> result = next(index.find_all_dupes())
-    >>> dupe1, dupe2 = result
-    >>> (dupe1, dupe2) == (hashes[1], hashes[0])
+    >>> pairs = list(index.find_all_dupes())
+    >>> len(pairs)
+    3
+    >>> (hashes[1], hashes[0]) in pairs
     True
+    >>> dupe1, dupe2 = hashes[1], hashes[0]
     >>> dupe1.similarity(dupe2)
     0.984375
     >>> dupe1.hamming_distance(dupe2)
     1
 
+    >>> # The number of blocks can be tuned from a sample of the hashes
+    >>> tuned = SimhashIndex.tuned(hashes, bits=2, target='latency')
+    >>> tuned.num_blocks, len(tuned.estimates)
+    (3, 30)
+    >>> estimate = tuned.estimates[0]
+    >>> estimate['num_blocks'], estimate['candidates'], estimate['cost']
+    (3, 2.0, 5.0)
+    >>> estimate['tables'], round(estimate['pairs'], 2), estimate['scan']
+    (3, 0.67, 11.0)
+    >>> SimhashIndex.tuned(hashes, bits=2, target='all_pairs').num_blocks
+    3
+
+    >>> # A compact index only stores hashes and (integer) document ids
+    >>> compact = SimhashIndex(
+    ...     [h.hash for h in hashes], compact=True, hashbits=64)
+    >>> list(compact.find_dupe_ids(simhash))
+    [0, 1]
+    >>> next(compact.find_dupes(simhash)) == hashes[0]
+    True
+    >>> compact.add(simhash, doc_id=42)
+    >>> compact.find_dupe_ids_many([simhash, hashes[2]])
+    [[42, 0, 1], [2]]
+    >>> [len(dupes) for dupes in compact.find_dupes_many(hashes)]
+    [3, 3, 1]
+    >>> labels, sizes = compact.clusters()
+    >>> list(labels), sizes
+    ([0, 0, 2, 0], {0: 3})
+    >>> labels, sizes = compact.clusters(key=lambda doc_id: -doc_id)
+    >>> list(labels), sizes
+    ([42, 42, 2, 42], {42: 3})
+    >>> compact.nearest_ids(simhash, k=2)
+    [42, 0]
+    >>> [h.hash for h in index.nearest(hashes[2], k=2)]
+    [13366613251191922586, 1318986352659762571]
+    >>> sorted(compact.find_all_dupe_ids())
+    [(0, 42), (1, 0), (1, 42)]
+    >>> sorted(compact.find_all_dupe_ids(workers=2))
+    [(0, 42), (1, 0), (1, 42)]
+
+    >>> # Documents can be removed (by id or hash), updated, and bulk added
+    >>> live = SimhashIndex(hashes, compact=True, purge_ratio=0.5)
+    >>> live.remove(1)
+    >>> list(live.find_dupe_ids(simhash)), len(live)
+    ([0], 2)
+    >>> live.update(0, simhash)  # removing 2 of the 3 rows purges them
+    >>> len(live), len(live.removed)
+    (2, 0)
+    >>> live.extend([hashes[0], hashes[1]], doc_ids=[10, 11])
+    >>> list(live.find_dupe_ids(simhash)), len(live)
+    ([0, 10, 11], 4)
+    >>> live.remove(simhash)
+    >>> len(live), len(live.removed)
+    (3, 1)
+
+    >>> # Streams can be deduped in one pass (with bounded memory)
+    >>> from changanya.simhash import dedupe_stream
+    >>>
+    >>> stream = iter([data[0], data[2], data[1], 'This is simhash test!'])
+    >>> for document, dupes in dedupe_stream(stream, annotate=True):
+    ...     print(dupes, document)
+    [] How are you? I Am fine. blar blar blar blar blar Thanks.
+    [] This is simhash test.
+    [0] How are you i am fine. blar blar blar blar blar than
+    [1] This is simhash test!
+    >>> len(list(dedupe_stream(data * 3, max_size=1000, max_age=60)))
+    2
+
+    >>> # An LSH index trades some recall for speed at large thresholds
+    >>> from changanya.lsh import LSHIndex
+    >>>
+    >>> lsh = LSHIndex(hashes, bits=8)
+    >>> list(lsh.find_dupe_ids(simhash))
+    [0, 1]
+    >>> round(lsh.recall(8), 4), round(lsh.recall(4), 4)
+    (0.999, 1.0)
+    >>> lsh.add(simhash, doc_id=42)
+    >>> lsh.find_dupe_ids_many([simhash, hashes[2]])
+    [[42, 0, 1], [2]]
+
+    >>> # Indexes can be saved and (memory mapped) loaded without rebuilding
+    >>> import os
+    >>> from tempfile import mkdtemp
+    >>>
+    >>> path = os.path.join(mkdtemp(), 'index.simhash')
+    >>> compact.save(path)
+    >>> with SimhashIndex.load(path) as loaded:
+    ...     len(loaded), list(loaded.find_dupe_ids(simhash))
+    (4, [42, 0, 1])
+    >>> loaded = SimhashIndex.load(path, mmap=False)
+    >>> loaded.add(hashes[2], doc_id=7)
+    >>> list(loaded.find_dupe_ids(hashes[2]))
+    [2, 7]
+
     >>> # Here is the basic Bloom filter use case
     >>> from changanya.bloom import Bloomfilter
     >>>
     >>> hash1 = Bloomfilter('test')
     >>> hash1.hashbits, hash1.num_hashes     # default values (see below)
-    (28756, 7)
+    (28759, 7)
     >>> hash1.add('test string')
     >>> 'test string' in hash1
     True
@@ -101,20 +242,133 @@ basic usage::
     True
     >>> hash2 = Bloomfilter(capacity=100, false_positive_rate=0.01)
     >>> hash2.hashbits, hash2.num_hashes
-    (959, 7)
+    (967, 7)
     >>> hash3 = Bloomfilter(capacity=1000000, false_positive_rate=0.01)
     >>> hash3.hashbits, hash3.num_hashes
-    (9585059, 7)
+    (9585061, 7)
     >>> hash4 = Bloomfilter(capacity=1000000, false_positive_rate=0.0001)
     >>> hash4.hashbits, hash4.num_hashes
-    (19170117, 14)
+    (19170119, 14)
+    >>> len(hash4.bits)  # the filter is stored as a mutable bytearray
+    2396265
     >>> hash1.hex()  # doctest: +ELLIPSIS
-    '0x100000000000000004...'
+    '0x800000000000000000...'
     >>> import zlib
     >>> len(hash1.hex())
-    7062
+    7069
     >>> len(zlib.compress(hash1.hex().encode('utf-8')))
-    220
+    215
+    >>> # The digest function is selectable (see `HASH_FUNCS`)
+    >>> hash5 = Bloomfilter(['a', 'b'], hash_func='murmur3')
+    >>> 'a' in hash5, 'c' in hash5
+    (True, False)
+    >>> hash6 = Bloomfilter('test', capacity=100, false_positive_rate=1e-12)
+    >>> hash6.num_hashes
+    40
+    >>> 'test' in hash6
+    True
+    >>> # Batches of items can be added and checked at once (vectorized with
+    >>> # numpy when it is installed)
+    >>> hash6.add_many(['foo', 'bar'])
+    >>> hash6.contains_many(['foo', 'bar', 'baz'])
+    [True, True, False]
+    >>> hash6.count
+    3
+
+    >>> # A scalable Bloom filter adds filters as needed to keep its
+    >>> # false positive rate in check
+    >>> from changanya.bloom import ScalableBloomfilter
+    >>>
+    >>> hash7 = ScalableBloomfilter(capacity=100, false_positive_rate=0.01)
+    >>> hash7.add_many(str(i) for i in range(1000))
+    >>> len(hash7.filters), hash7.count, hash7.capacity
+    (4, 1000, 1500)
+    >>> hash7.add_many(['999', 'new', 'new'])  # only 'new' is counted
+    >>> hash7.count
+    1001
+    >>> '999' in hash7, 'holy diver' in hash7
+    (True, False)
+    >>> hash7.estimated_false_positive_rate < 0.01
+    True
+
+    >>> # A counting Bloom filter supports removing items
+    >>> from changanya.bloom import CountingBloomfilter
+    >>>
+    >>> hash8 = CountingBloomfilter(['foo', 'bar'])
+    >>> hash8.remove('foo')
+    >>> 'foo' in hash8, 'bar' in hash8
+    (False, True)
+    >>> hash8.to_bloomfilter() == Bloomfilter('bar')
+    True
+    >>> # Filters (and their counters) survive pickling and copying
+    >>> import pickle
+    >>> hash8.add('bar')
+    >>> copied = pickle.loads(pickle.dumps(hash8))
+    >>> copied.counters == hash8.counters
+    True
+    >>> copied.remove('bar')
+    >>> 'bar' in copied
+    True
+
+    >>> # Filters can be serialized, saved, and memory mapped
+    >>> data = hash1.to_bytes()
+    >>> len(data) == 64 + len(hash1.bits)
+    True
+    >>> Bloomfilter.from_bytes(data) == hash1
+    True
+    >>> odd = Bloomfilter(['a', 'b'], capacity=1000.9)  # sized for 1000
+    >>> odd.capacity, odd.hashbits
+    (1000, 9587)
+    >>> Bloomfilter.from_bytes(odd.to_bytes()).contains_many(['a', 'b'])
+    [True, True]
+    >>> path = os.path.join(mkdtemp(), 'filter.bloom')
+    >>> hash1.save(path)
+    >>> with Bloomfilter.open(path) as mapped:
+    ...     'these' in mapped, 'holy diver' in mapped, mapped.count
+    (True, False, 11)
+
+    >>> # Filters with the same parameters can be combined
+    >>> left = Bloomfilter(['foo', 'bar'])
+    >>> right = Bloomfilter(['bar', 'baz'])
+    >>> (left | right).contains_many(['foo', 'bar', 'baz'])
+    [True, True, True]
+    >>> (left & right).contains_many(['foo', 'bar', 'baz'])
+    [False, True, False]
+    >>> left |= right
+    >>> left == Bloomfilter(['foo', 'bar', 'baz'])
+    True
+    >>> words = map(str, range(1000))
+    >>> hash11 = Bloomfilter.build_parallel(words, workers=2, batch_size=100)
+    >>> hash11.count, all(hash11.contains_many(map(str, range(1000))))
+    (1000, True)
+    >>> # A worker's error is raised in the parent (ints aren't encodable)
+    >>> Bloomfilter.build_parallel(range(100), workers=2, batch_size=1)
+    Traceback (most recent call last):
+    TypeError: object supporting the buffer API required
+
+    >>> # A blocked Bloom filter keeps each item's bits in one cache line
+    >>> from changanya.bloom import BlockedBloomfilter
+    >>>
+    >>> hash9 = BlockedBloomfilter(['foo', 'bar'])
+    >>> hash9.hashbits, hash9.num_blocks, hash9.num_hashes
+    (29184, 57, 7)
+    >>> hash9.contains_many(['foo', 'bar', 'baz'])
+    [True, True, False]
+
+    >>> # A concurrent Bloom filter can be shared between threads
+    >>> from threading import Thread
+    >>> from changanya.bloom import ConcurrentBloomfilter
+    >>>
+    >>> hash10 = ConcurrentBloomfilter(stripes=16)
+    >>> threads = [
+    ...     Thread(target=hash10.add_many, args=(map(str, range(i, 800, 8)),))
+    ...     for i in range(8)]
+    >>> for thread in threads:
+    ...     thread.start()
+    >>> for thread in threads:
+    ...     thread.join()
+    >>> hash10.count, all(hash10.contains_many(map(str, range(800))))
+    (800, True)
 
     >>> # Geohash example
     >>> from changanya.geohash import Geohash
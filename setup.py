@@ -46,7 +46,7 @@ setup(
         'examples': ['examples/*']
     },
     install_requires=[],
-    extras_require={'develop': dev_requirements},
+    extras_require={'develop': dev_requirements, 'numpy': ['numpy']},
     setup_requires=setup_require,
     test_suite='nose.collector',
     tests_require=dev_requirements,